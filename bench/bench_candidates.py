@@ -0,0 +1,93 @@
+"""Память и аллокации кандидатов: dict на кандидата (как было) vs candidate.Candidate.
+
+    python bench/bench_candidates.py [поисков]
+
+Сырые ответы SC строятся один раз, дальше под tracemalloc меряем:
+  - сколько памяти держит кэш поиска с N выдачами по 20 кандидатов;
+  - сколько аллоцируется за показ выдачи (3 показа на поиск - попадания в кэш)."""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from candidate import Candidate
+from utils import format_plays
+
+WORDS = "numb linkin park in the end faint believer imagine dragons thunder кино группа крови official video".split()
+
+def make_raw(rnd, n=20):
+    return [{
+        'id': rnd.randint(10 ** 8, 10 ** 9),
+        'title': " ".join(rnd.choices(WORDS, k=rnd.randint(2, 6))).title(),
+        'user': {'username': " ".join(rnd.choices(WORDS, k=2)).title(), 'avatar_url': 'https://i1.sndcdn.com/avatars-large.jpg'},
+        'playback_count': rnd.randint(0, 10 ** 8),
+        'duration': rnd.randint(30, 600) * 1000,
+        'artwork_url': 'https://i1.sndcdn.com/artworks-000-large.jpg',
+        'media': {'transcodings': [{'url': f'https://api-v2.soundcloud.com/media/soundcloud:tracks:{i}/x/stream/progressive',
+                                    'format': {'protocol': 'progressive'}}]},
+    } for i in range(n)]
+
+def build_dict(raw):
+    return [{
+        'source': 'SC', 'id': str(item['id']),
+        'title': item['title'][:100], 'artist': item['user']['username'][:50],
+        'playback_count': item['playback_count'], 'duration': item['duration'],
+        'artwork_url': item['artwork_url'].replace('large', 't500x500'),
+        'media_url_template': item['media']['transcodings'][0]['url'],
+        'score': 0,
+    } for item in raw]
+
+def render_dict(items):
+    out = []
+    for item in items:
+        clean_title = item['title'].replace(item['artist'], '').strip(' -|:').replace('.mp3', '')
+        if not clean_title: clean_title = item['title']
+        m, s = divmod(item['duration'] // 1000, 60)
+        out.append((clean_title, f"{item['artist']}\n{m:02d}:{s:02d} • {format_plays(item['playback_count'])}"))
+    return out
+
+def build_slots(raw):
+    return [Candidate(
+        'SC', str(item['id']), item['title'][:100], item['user']['username'][:50],
+        item['playback_count'], item['duration'],
+        item['artwork_url'].replace('large', 't500x500'),
+        item['media']['transcodings'][0]['url'],
+    ) for item in raw]
+
+def render_slots(items):
+    return [(item.clean_title, f"{item.artist}\n{item.duration_text} • {item.plays_text}") for item in items]
+
+def measure(build, render, raws, renders=3):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    cache = [build(raw) for raw in raws]
+    retained = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(renders):
+        for items in cache: render(items)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - before
+    # Что осталось после показов: ленивые поля Candidate остаются в кэше
+    retained_after = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return retained, retained_after, peak, elapsed
+
+def main():
+    searches = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rnd = random.Random(7)
+    raws = [make_raw(rnd) for _ in range(searches)]
+    n = searches * 20
+
+    print(f"searches: {searches}, candidates: {n}, renders/search: 3")
+    print(f"{'':>6} {'retained B/cand':>16} {'after render':>14} {'render peak KB':>15} {'time ms':>9}")
+    for name, build, render in (("dict", build_dict, render_dict), ("slots", build_slots, render_slots)):
+        retained, after, peak, elapsed = measure(build, render, raws)
+        print(f"{name:>6} {retained / n:16.0f} {after / n:14.0f} {peak / 1024:15.0f} {elapsed * 1000:9.1f}")
+
+if __name__ == "__main__":
+    main()
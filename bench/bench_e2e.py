@@ -0,0 +1,445 @@
+"""Нагрузочный прогон без интернета: настоящие MultiEngine, KeyManager и хендлеры против
+локальных заглушек SoundCloud (api-v2 + страница/скрипты для ключа), Piped-зеркал и Bot API.
+
+    python bench/bench_e2e.py [--ops 400] [--concurrency 20] [--sc-latency 0.15] [--piped-error 0.1] ...
+    python bench/bench_e2e.py --help
+
+Заглушки: один HTTPS сервер (самоподписанный сертификат через openssl) - на него резолвятся
+soundcloud.com, api-v2.soundcloud.com, a-v2.sndcdn.com и piped-N.bench; Bot API и аудио - по HTTP.
+Нагрузка: виртуальные юзеры шлют инлайн-запросы (популярность по Ципфу) через Dispatcher.feed_update
+и с вероятностью --click-rate кликают верхний трек. Печатает p50/p95/p99 ответа на инлайн и
+клика до аудио, пропускную способность и счётчики запросов к апстримам; всё пишется в JSON
+(по умолчанию bench/results/e2e-<время>.json) для сравнения прогонов.
+
+База не используется, если не задан DATABASE_URL: тогда каждый клик по новому треку - заливка."""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# config читает окружение при импорте - заполняем до него
+os.environ.setdefault("TG_TOKEN", "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH")
+os.environ.setdefault("CACHE_CHANNEL_ID", "-1000000000001")
+os.environ.setdefault("BYPASS_CHANNEL_ID", "-1000000000002")
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import engines
+from botapi import BotApiScheduler
+from config import (
+    TG_TOKEN, CACHE_CHANNEL_ID, BOTAPI_RATE, BOTAPI_CHAT_INTERVAL, BOTAPI_MAX_RETRIES, BOTAPI_MAX_RETRY_AFTER
+)
+from engines import KeyManager, MultiEngine
+from limiter import hosts
+import handlers
+import tracing
+
+WORDS = ("numb linkin park in the end faint believer imagine dragons thunder кино группа крови "
+         "звезда по имени солнце nirvana smells like teen spirit daft punk around world metallica "
+         "one queen bohemian rhapsody radiohead creep muse hysteria").split()
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--ops", type=int, default=400, help="инлайн-запросов всего")
+    p.add_argument("--concurrency", type=int, default=20, help="виртуальных юзеров одновременно")
+    p.add_argument("--queries", type=int, default=150, help="разных запросов в каталоге")
+    p.add_argument("--zipf", type=float, default=1.1, help="крутизна популярности запросов")
+    p.add_argument("--click-rate", type=float, default=0.3, help="доля запросов, закончившихся кликом")
+    p.add_argument("--think", type=float, default=0.05, help="сек паузы юзера между действиями")
+    p.add_argument("--sc-latency", type=float, default=0.15, help="сек, среднее (±50%%)")
+    p.add_argument("--sc-error", type=float, default=0.0, help="доля 503 от api-v2")
+    p.add_argument("--sc-items", type=int, default=10, help="треков в ответе поиска SC")
+    p.add_argument("--piped-latency", type=float, default=0.3)
+    p.add_argument("--piped-error", type=float, default=0.05)
+    p.add_argument("--piped-items", type=int, default=10)
+    p.add_argument("--mirrors", type=int, default=3, help="Piped-зеркал")
+    p.add_argument("--pad", type=int, default=200, help="байт мусора в каждом элементе выдачи (размер ответа)")
+    p.add_argument("--bot-latency", type=float, default=0.05)
+    p.add_argument("--bot-429", type=float, default=0.0, help="доля ответов 429 (retry_after=1) от Bot API")
+    p.add_argument("--bot-rate", type=float, default=None, help="лимит планировщика Bot API (по умолчанию из config)")
+    p.add_argument("--chat-interval", type=float, default=BOTAPI_CHAT_INTERVAL,
+                   help="сек между вызовами в один чат (кэш-канал тоже чат: задаёт потолок заливок)")
+    p.add_argument("--audio-kb", type=int, default=256, help="размер 'mp3', который заливается в кэш-канал")
+    p.add_argument("--rotate-key", type=float, default=0, help="сек: менять client_id SC (0 - не менять)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", default=None, help="JSON с результатами")
+    p.add_argument("-v", "--verbose", action="store_true", help="логи бота уровня INFO")
+    return p.parse_args()
+
+def percentiles(values):
+    if not values: return {'n': 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+    return {
+        'n': len(ordered), 'p50': round(pick(0.50), 4), 'p95': round(pick(0.95), 4),
+        'p99': round(pick(0.99), 4), 'max': round(ordered[-1], 4),
+    }
+
+def make_cert(tmp):
+    cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+         "-days", "1", "-subj", "/CN=bench"],
+        check=True, capture_output=True
+    )
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+def listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+class LocalResolver(AbstractResolver):
+    """Любой хост -> наш HTTPS сервер"""
+
+    def __init__(self, port):
+        self.port = port
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{'hostname': host, 'host': '127.0.0.1', 'port': self.port,
+                 'family': socket.AF_INET, 'proto': 0, 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+class Upstreams:
+    """Заглушки всех внешних сервисов и счётчики запросов к ним"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.calls = Counter()
+        self.client_id = self.new_key() # FALLBACK_CLIENT_ID заведомо не подходит: первый поиск словит 401
+        self.answers = {} # inline_query_id -> id результатов
+        self.http_base = None # http://127.0.0.1:port для аудио и Bot API
+        self.message_id = 0
+        self.pad = "x" * args.pad
+
+    def new_key(self):
+        return "".join(self.rnd.choices("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", k=32))
+
+    async def delay(self, mean):
+        if mean: await asyncio.sleep(mean * self.rnd.uniform(0.5, 1.5))
+
+    def fail(self, rate):
+        return rate and self.rnd.random() < rate
+
+    @staticmethod
+    def tracks_for(query, n):
+        """Детерминированная выдача: одинаковый запрос - одинаковые id (клики сходятся на одних треках)"""
+        seed = int(hashlib.md5(query.lower().encode()).hexdigest()[:8], 16)
+        rnd = random.Random(seed)
+        words = query.split() or ["track"]
+        out = []
+        for i in range(n):
+            extra = " ".join(rnd.choices(WORDS, k=rnd.randint(0, 2)))
+            out.append((seed * 100 + i, f"{' '.join(words[1:]) or words[0]} {extra}".strip().title(),
+                        words[0].title(), rnd.randint(0, 10 ** 7), rnd.randint(90, 400)))
+        return out
+
+    # --- SoundCloud ---
+
+    async def sc(self, request):
+        path = request.path
+        if request.host.startswith("soundcloud.com"):
+            self.calls['sc.discover'] += 1
+            scripts = "".join(f'<script src="https://a-v2.sndcdn.com/assets/{i}-bench.js"></script>' for i in range(5))
+            return web.Response(text=f"<html>{scripts}</html>", content_type="text/html")
+        if request.host.startswith("a-v2.sndcdn.com"):
+            self.calls['sc.script'] += 1
+            body = f'var a={{client_id:"{self.client_id}"}};' if path.startswith("/assets/4") else "var b=1;"
+            return web.Response(text=body, content_type="application/javascript")
+
+        await self.delay(self.args.sc_latency)
+        if request.query.get('client_id') != self.client_id:
+            self.calls['sc.401'] += 1
+            return web.Response(status=401)
+        if self.fail(self.args.sc_error):
+            self.calls['sc.503'] += 1
+            return web.Response(status=503)
+
+        if path == "/search/tracks":
+            self.calls['sc.search'] += 1
+            limit = min(int(request.query.get('limit', 10)), self.args.sc_items)
+            return web.json_response({'collection': [
+                self.sc_track(*t) for t in self.tracks_for(request.query.get('q', ''), limit)
+            ]})
+        if path.startswith("/tracks/"):
+            self.calls['sc.track'] += 1
+            track_id = int(path.rsplit("/", 1)[-1])
+            return web.json_response(self.sc_track(track_id, "Track", "Artist", 0, 200))
+        if path.startswith("/media/"):
+            self.calls['sc.media'] += 1
+            track_id = path.split(":")[2].split("/")[0]
+            return web.json_response({'url': f"{self.http_base}/audio/SC/{track_id}.mp3"})
+        return web.Response(status=404)
+
+    def sc_track(self, track_id, title, artist, plays, seconds):
+        return {
+            'id': track_id, 'title': title, 'streamable': True, 'playback_count': plays,
+            'duration': seconds * 1000, 'artwork_url': f"{self.http_base}/img/artworks-large.jpg",
+            'user': {'username': artist, 'avatar_url': f"{self.http_base}/img/avatars-large.jpg"},
+            'media': {'transcodings': [{
+                'url': f"https://api-v2.soundcloud.com/media/soundcloud:tracks:{track_id}/bench/stream/progressive",
+                'format': {'protocol': 'progressive'},
+            }]},
+            'description': self.pad,
+        }
+
+    # --- Piped ---
+
+    async def piped(self, request):
+        path = request.path
+        if path == "/healthcheck":
+            self.calls['piped.health'] += 1
+            return web.Response(text="OK")
+        await self.delay(self.args.piped_latency)
+        if self.fail(self.args.piped_error):
+            self.calls['piped.503'] += 1
+            return web.Response(status=503)
+        if path == "/search":
+            self.calls['piped.search'] += 1
+            return web.json_response({'items': [{
+                'url': f"/watch?v=yt{track_id}", 'title': title, 'uploaderName': artist,
+                'views': plays, 'duration': seconds, 'thumbnail': f"{self.http_base}/img/hq.jpg",
+                'description': self.pad,
+            } for track_id, title, artist, plays, seconds in self.tracks_for(request.query.get('q', ''), self.args.piped_items)]})
+        if path.startswith("/streams/"):
+            self.calls['piped.streams'] += 1
+            video_id = path.rsplit("/", 1)[-1]
+            return web.json_response({
+                'title': 'Video', 'uploader': 'Channel', 'thumbnailUrl': f"{self.http_base}/img/hq.jpg",
+                'audioStreams': [{'url': f"{self.http_base}/audio/YT/{video_id}.m4a", 'format': 'M4A'}],
+            })
+        return web.Response(status=404)
+
+    async def https(self, request):
+        if request.host.startswith("piped-"):
+            return await self.piped(request)
+        return await self.sc(request)
+
+    # --- Аудио и Bot API ---
+
+    async def audio(self, request):
+        self.calls['audio.download'] += 1
+        return web.Response(body=b"\0" * (self.args.audio_kb * 1024), content_type="audio/mpeg")
+
+    async def image(self, request):
+        self.calls['img.download'] += 1
+        return web.Response(body=b"\xff\xd8" + b"\0" * 4096, content_type="image/jpeg")
+
+    async def bot_api(self, request):
+        method = request.match_info['method'].lower()
+        form = await request.post() # multipart целиком, вместе с файлом
+        self.calls[f'bot.{method}'] += 1
+        await self.delay(self.args.bot_latency)
+        if method not in ('getme', 'deletewebhook') and self.fail(self.args.bot_429):
+            self.calls['bot.429'] += 1
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                      'parameters': {'retry_after': 1}})
+        return web.json_response({'ok': True, 'result': self.bot_result(method, form)})
+
+    def bot_result(self, method, form):
+        if method == 'getme':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'answerinlinequery':
+            self.answers[form['inline_query_id']] = [r['id'] for r in json.loads(form['results'])]
+            return True
+        self.message_id += 1
+        if method == 'sendaudio':
+            upload = form.get('audio')
+            size = len(upload.file.read()) if hasattr(upload, 'file') else 0
+            return {
+                'message_id': self.message_id, 'date': int(time.time()),
+                'chat': {'id': CACHE_CHANNEL_ID, 'type': 'channel'},
+                'audio': {'file_id': f"AUDIO{self.message_id}", 'file_unique_id': f"U{self.message_id}",
+                          'duration': 200, 'file_size': size},
+            }
+        if method == 'copymessage':
+            return {'message_id': self.message_id}
+        return True
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/audio/{source}/{name}", self.audio)
+        app.router.add_get("/img/{name}", self.image)
+        app.router.add_route("*", "/{tail:.*}", self.https)
+        return app
+
+async def rotate_keys(upstreams, every):
+    while True:
+        await asyncio.sleep(every)
+        upstreams.client_id = upstreams.new_key()
+        upstreams.calls['sc.key_rotated'] += 1
+
+class Workload:
+    def __init__(self, args, dp, bot, upstreams):
+        self.args = args
+        self.dp = dp
+        self.bot = bot
+        self.upstreams = upstreams
+        self.rnd = random.Random(args.seed + 1)
+        self.queries = [" ".join(self.rnd.sample(WORDS, self.rnd.randint(2, 4))) for _ in range(args.queries)]
+        self.weights = [1 / (rank + 1) ** args.zipf for rank in range(args.queries)]
+        self.inline = []
+        self.clicks = []
+        self.outcomes = Counter()
+        self.seq = 0
+
+    def next_id(self):
+        self.seq += 1
+        return self.seq
+
+    def update(self, **payload):
+        return Update.model_validate({'update_id': self.next_id(), **payload}, context={'bot': self.bot})
+
+    async def user(self, user_id, ops):
+        sender = {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'}
+        for _ in range(ops):
+            query = self.rnd.choices(self.queries, self.weights)[0]
+            query_id = f"q{self.next_id()}"
+            start = time.perf_counter()
+            await self.dp.feed_update(self.bot, self.update(inline_query={
+                'id': query_id, 'from': sender, 'query': query, 'offset': '',
+            }))
+            self.inline.append(time.perf_counter() - start)
+            results = self.upstreams.answers.pop(query_id, None)
+            if not results:
+                self.outcomes['inline_empty'] += 1
+            elif self.rnd.random() < self.args.click_rate:
+                top = results[0]
+                if top.startswith("c:"):
+                    self.outcomes['click_cached_audio'] += 1 # уже залит: аудио отправляется без бота
+                else:
+                    start = time.perf_counter()
+                    await self.dp.feed_update(self.bot, self.update(chosen_inline_result={
+                        'result_id': top, 'from': sender, 'query': query,
+                        'inline_message_id': f"im{self.next_id()}",
+                    }))
+                    self.clicks.append(time.perf_counter() - start)
+                    self.outcomes['click_upload_path'] += 1
+            await asyncio.sleep(self.args.think)
+
+    async def run(self):
+        per_user, extra = divmod(self.args.ops, self.args.concurrency)
+        await asyncio.gather(*(
+            self.user(10 ** 6 + i, per_user + (i < extra)) for i in range(self.args.concurrency)
+        ))
+
+async def bench(args):
+    tmp = tempfile.mkdtemp(prefix="bench-e2e-")
+    upstreams = Upstreams(args)
+    runner = web.AppRunner(upstreams.app())
+    await runner.setup()
+    https_sock, http_sock = listen(), listen()
+    await web.SockSite(runner, https_sock, ssl_context=make_cert(tmp)).start()
+    await web.SockSite(runner, http_sock).start()
+    https_port = https_sock.getsockname()[1]
+    http_port = http_sock.getsockname()[1]
+    upstreams.http_base = f"http://127.0.0.1:{http_port}"
+
+    # Как в main.py, только резолвер ведёт все хосты на заглушку
+    connector = aiohttp.TCPConnector(limit=100, ssl=False, resolver=LocalResolver(https_port))
+    session = aiohttp.ClientSession(connector=connector)
+    engines.PIPED_MIRRORS = [f"https://piped-{i}.bench" for i in range(args.mirrors)]
+
+    bot = Bot(
+        token=TG_TOKEN, default=DefaultBotProperties(parse_mode="HTML"),
+        session=AiohttpSession(api=TelegramAPIServer.from_base(upstreams.http_base)),
+    )
+    api = BotApiScheduler(
+        args.bot_rate or BOTAPI_RATE, args.chat_interval, BOTAPI_MAX_RETRIES, BOTAPI_MAX_RETRY_AFTER,
+        background_chats=[CACHE_CHANNEL_ID]
+    )
+    bot.session.middleware(api)
+    dp = Dispatcher()
+
+    key_manager = KeyManager(session)
+    engine = MultiEngine(session, key_manager)
+    engine.yt.mirrors.start()
+    handlers.setup_handlers(engine, bot)
+    dp.include_router(handlers.router)
+    rotator = asyncio.create_task(rotate_keys(upstreams, args.rotate_key)) if args.rotate_key else None
+
+    workload = Workload(args, dp, bot, upstreams)
+    started = time.perf_counter()
+    await workload.run()
+    elapsed = time.perf_counter() - started
+
+    if rotator: rotator.cancel()
+    report = {
+        'args': vars(args),
+        'elapsed_s': round(elapsed, 3),
+        'throughput': {
+            'inline_per_s': round(len(workload.inline) / elapsed, 2),
+            'clicks_per_s': round(len(workload.clicks) / elapsed, 2),
+        },
+        'inline_answer_s': percentiles(workload.inline),
+        'click_to_audio_s': percentiles(workload.clicks),
+        'outcomes': dict(workload.outcomes),
+        'upstream_calls': dict(sorted(upstreams.calls.items())),
+        'search_cache': engine.cache_stats(),
+        'limiters': {'SC': engine.sc.limiter.snapshot(), 'YT': engine.yt.limiter.snapshot(), **hosts.snapshot()},
+        'mirrors': engine.yt.mirrors.snapshot(),
+        'transfers': handlers.transfers.snapshot(),
+        'bot_api': api.snapshot(),
+        # Хвост с разбивкой по спанам: куда ушло время у самых медленных кликов
+        'slowest_clicks': [t.to_dict() for t in tracing.slowest(3, 'click')],
+    }
+    await tracing.flush()
+
+    await session.close()
+    await bot.session.close()
+    await runner.cleanup()
+    return report
+
+def print_report(report, out):
+    print(f"elapsed {report['elapsed_s']}s  inline/s {report['throughput']['inline_per_s']}  "
+          f"clicks/s {report['throughput']['clicks_per_s']}")
+    print(f"{'':>16} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for name in ('inline_answer_s', 'click_to_audio_s'):
+        row = report[name]
+        if not row['n']:
+            print(f"{name:>16} {0:>6}")
+            continue
+        print(f"{name:>16} {row['n']:>6} {row['p50']:>8} {row['p95']:>8} {row['p99']:>8} {row['max']:>8}")
+    print("upstream:", ", ".join(f"{k}={v}" for k, v in report['upstream_calls'].items()))
+    print("outcomes:", ", ".join(f"{k}={v}" for k, v in report['outcomes'].items()))
+    print(f"-> {out}")
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s - [%(levelname)s] - %(name)s - %(message)s")
+    report = asyncio.run(bench(args))
+    out = args.out or os.path.join(ROOT, "bench", "results", time.strftime("e2e-%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report, out)
+
+if __name__ == "__main__":
+    main()
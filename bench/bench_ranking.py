@@ -0,0 +1,131 @@
+"""Микробенчмарк ранжирования: старый calculate_score по кандидату vs ranking.QueryRanker.
+
+    python bench/bench_ranking.py [поисков]
+
+Проверяет, что порядок и очки совпадают, и печатает CPU на один поиск (20 кандидатов)."""
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from candidate import Candidate
+from config import BANNED_WORDS
+from ranking import QueryRanker
+from utils import clean_query
+
+def legacy_score(item, query_raw):
+    """utils.calculate_score до перехода на ranking.QueryRanker - эталон порядка"""
+    score = 0
+    query_clean = clean_query(query_raw)
+    query_words = set(query_clean.split())
+    
+    title_lower = item['title'].lower()
+    artist_lower = item['artist'].lower()
+    full_text = f"{artist_lower} {title_lower}"
+    
+    import re
+    item_words = set(re.findall(r'\w+', full_text))
+
+    # 1 СОВПАДЕНИЕ СЛОВ
+    if not query_words: return 0
+
+    common_words = query_words.intersection(item_words)
+    coverage = len(common_words) / len(query_words)
+
+    if coverage == 1.0:      
+        score += 300 
+    elif coverage >= 0.66:   
+        score += 100 
+    elif coverage > 0:
+        score += 50
+    else:
+        return -100
+
+    # 2 ТОЧНАЯ ФРАЗА
+    if query_clean in full_text:
+        score += 100
+
+    # 3 ПОПУЛЯРНОСТЬ
+    plays = item.get('playback_count', 0) or 0
+    if plays > 0:
+        try:
+            score += math.log10(plays) * 20
+        except: pass
+
+    # 4 БОНУС SC УБРАН
+    # Раньше здесь было +10 для SC, теперь условия равны
+
+    # 5 ШТРАФЫ
+    dur = item.get('duration', 0) / 1000
+    if dur < 40: score -= 50
+    elif dur > 900: score -= 30
+
+    is_clean_search = not any(w in query_clean for w in BANNED_WORDS)
+    if is_clean_search:
+        for bad in BANNED_WORDS:
+            if bad in title_lower:
+                score -= 50
+
+    return score
+
+WORDS = ("numb linkin park in the end faint crawling believer imagine dragons thunder radioactive "
+         "кино группа крови звезда по имени солнце official video lyrics hd remastered "
+         "feat original mix 2023 music песня").split()
+EXTRA = sorted(BANNED_WORDS) + ["deliver", "alive", "reverberation", "slowed + reverb"]
+QUERIES = ["linkin park numb", "numb", "imagine dragons believer", "кино группа крови",
+           "скачать звезда по имени солнце", "numb live", "thunder remix", "in the end mp3"]
+
+def make_candidates(rnd, n=20):
+    out = []
+    for i in range(n):
+        title = " ".join(rnd.choices(WORDS, k=rnd.randint(2, 6)))
+        if rnd.random() < 0.3: title += " " + rnd.choice(EXTRA)
+        out.append({
+            'source': rnd.choice(('SC', 'YT')), 'id': str(i),
+            'title': title.title()[:100],
+            'artist': " ".join(rnd.choices(WORDS, k=rnd.randint(1, 3))).title()[:50],
+            'playback_count': rnd.choice((0, rnd.randint(1, 10 ** 8))),
+            'duration': rnd.randint(10, 1200) * 1000,
+        })
+    return out
+
+def run_legacy(query, items):
+    for c in items: c['score'] = legacy_score(c, query)
+    items.sort(key=lambda x: x['score'], reverse=True)
+    return items
+
+def run_ranker(query, items):
+    return QueryRanker(query).rank(items)
+
+def as_candidates(items):
+    return [Candidate(c['source'], c['id'], c['title'], c['artist'], c['playback_count'], c['duration'])
+            for c in items]
+
+def main():
+    searches = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rnd = random.Random(42)
+    workload = [(rnd.choice(QUERIES), make_candidates(rnd)) for _ in range(searches)]
+
+    for query, items in workload:
+        a = run_legacy(query, [dict(c) for c in items])
+        b = run_ranker(query, as_candidates(items))
+        assert [(c['id'], c['score']) for c in a] == [(c.id, c.score) for c in b], query
+
+    timings = {}
+    for name, fn, copy in (("legacy", run_legacy, lambda items: [dict(c) for c in items]),
+                           ("ranker", run_ranker, as_candidates)):
+        copies = [(q, copy(items)) for q, items in workload]
+        start = time.perf_counter()
+        for query, items in copies: fn(query, items)
+        timings[name] = (time.perf_counter() - start) / searches * 1e6
+
+    print(f"searches: {searches}, candidates/search: 20, ordering: identical")
+    for name, us in timings.items(): print(f"{name:>7}: {us:8.1f} us/search")
+    print(f" saving: {timings['legacy'] - timings['ranker']:8.1f} us/search "
+          f"({(1 - timings['ranker'] / timings['legacy']) * 100:.0f}%)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.methods import GetUpdates, GetMe, SetWebhook, DeleteWebhook, AnswerInlineQuery, AnswerCallbackQuery
+import tracing
+from metrics import TELEGRAM_ERRORS
+
+logger = logging.getLogger("BOTAPI")
+
+# Меньше - раньше
+API_PRIORITY_USER = 0 # правки сообщений юзера, ответы на инлайн/колбэки
+API_PRIORITY_CACHE = 1 # заливки в кэш-канал: юзер их не видит напрямую
+API_PRIORITY_BULK = 2 # рассылки: ждут всех
+
+# Задача может понизить приоритет всех своих вызовов (рассылка ставит BULK один раз)
+api_priority = contextvars.ContextVar("api_priority", default=None)
+
+# Служебные вызовы идут мимо очереди (getUpdates висит долго и не считается в лимит)
+UNTHROTTLED = (GetUpdates, GetMe, SetWebhook, DeleteWebhook)
+# Ответы на инлайн-запросы и колбэки - не сообщения: лимит ~30/с на них не распространяется,
+# а инлайн-ответ, простоявший в общей очереди, Telegram отвергнет как "query is too old"
+UNMETERED = (AnswerInlineQuery, AnswerCallbackQuery)
+
+class BotApiScheduler(BaseRequestMiddleware):
+    """Все вызовы Bot API через одну очередь: общий лимит в секунду, интервал на чат,
+    приоритеты и ожидание по retry_after вместо ошибки. Лимит - на процесс: при WORKERS > 1
+    main делит BOTAPI_RATE между воркерами"""
+
+    def __init__(self, rate, chat_interval, max_retries, max_retry_after, background_chats=()):
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.background_chats = set(background_chats)
+        self.queue = [] # (приоритет, порядок, future)
+        self.seq = itertools.count()
+        self.next_slot = 0.0 # когда можно следующий вызов (общий лимит)
+        self.paused_until = 0.0 # глобальный 429
+        self.chat_next = {} # чат/инлайн-сообщение -> когда можно следующий вызов
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stats = {'calls': 0, 'queued': 0, 'retry_after': 0, 'gave_up': 0}
+
+    def priority_of(self, method):
+        forced = api_priority.get()
+        if forced is not None: return forced
+        chat_id = getattr(method, 'chat_id', None)
+        return API_PRIORITY_CACHE if chat_id in self.background_chats else API_PRIORITY_USER
+
+    @staticmethod
+    def chat_of(method):
+        return getattr(method, 'chat_id', None) or getattr(method, 'inline_message_id', None)
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, UNTHROTTLED):
+            return await make_request(bot, method)
+
+        priority = self.priority_of(method)
+        chat = self.chat_of(method)
+        metered = not isinstance(method, UNMETERED)
+        name = type(method).__name__
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            await self._acquire(priority, chat, metered)
+            sent = time.perf_counter()
+            self.stats['calls'] += 1
+            try:
+                return await make_request(bot, method)
+            except TelegramAPIError as e:
+                TELEGRAM_ERRORS.inc(name, type(e).__name__)
+                if not isinstance(e, TelegramRetryAfter): raise
+                self.stats['retry_after'] += 1
+                if attempt == self.max_retries or e.retry_after > self.max_retry_after:
+                    self.stats['gave_up'] += 1
+                    raise
+                logger.warning(f"🐢 429 на {name}: ждём {e.retry_after}с")
+                self._backoff(chat, e.retry_after)
+            finally:
+                # Ожидание в очереди планировщика отдельно от самого запроса
+                tracing.add(name, queued, wait=tracing.ms(sent - queued))
+
+    def _backoff(self, chat, retry_after):
+        # Флуд в конкретном чате тормозит только его, без чата - всех
+        until = asyncio.get_running_loop().time() + retry_after
+        if chat is None:
+            self.paused_until = max(self.paused_until, until)
+        else:
+            self.chat_next[chat] = max(self.chat_next.get(chat, 0.0), until)
+
+    async def _acquire(self, priority, chat, metered=True):
+        loop = asyncio.get_running_loop()
+        if chat is not None:
+            # Резервируем слот в чате заранее: параллельные вызовы встают друг за другом
+            now = loop.time()
+            slot = max(now, self.chat_next.get(chat, 0.0))
+            self.chat_next[chat] = slot + self.chat_interval
+            if slot > now: await asyncio.sleep(slot - now)
+            if len(self.chat_next) > 10000: self._sweep(loop.time())
+
+        now = loop.time()
+        if not metered:
+            # Мимо общего лимита, но глобальный 429 пережидаем вместе со всеми
+            if self.paused_until > now: await asyncio.sleep(self.paused_until - now)
+            return
+        if not self.queue and now >= self.next_slot and now >= self.paused_until:
+            # Быстрый путь: очередь пуста, лимит не выбран
+            self.next_slot = now + self.interval
+            return
+
+        self.stats['queued'] += 1
+        future = loop.create_future()
+        heapq.heappush(self.queue, (priority, next(self.seq), future))
+        if self.task is None: self.task = asyncio.create_task(self._pump())
+        self.wakeup.set()
+        await future
+
+    def _sweep(self, now):
+        for chat in [c for c, t in self.chat_next.items() if t < now]:
+            del self.chat_next[chat]
+
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.queue:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            wait = max(self.next_slot, self.paused_until) - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            # Приоритет проверяем в момент выдачи слота: правки юзеру обгоняют заливки
+            _, _, future = heapq.heappop(self.queue)
+            if future.done(): continue # ожидающего отменили
+            future.set_result(None)
+            self.next_slot = loop.time() + self.interval
+
+    def snapshot(self):
+        return {**self.stats, 'waiting': len(self.queue)}
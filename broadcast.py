@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+import ujson
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from botapi import api_priority, API_PRIORITY_BULK
+from database import get_state, set_state, advisory_lock, iter_active_users, mark_inactive
+
+logger = logging.getLogger("BROADCAST")
+
+STATE_KEY = "broadcast"
+
+class Broadcaster:
+    """Рассылка copy_message по активным юзерам: ровный темп, прогресс в bot_state
+    (после падения/деплоя продолжаем с последнего user_id), заблокировавшие гасятся пачками"""
+
+    def __init__(self, rate, page, concurrency):
+        self.interval = 1 / rate
+        self.page = page
+        self.concurrency = concurrency
+        self.bot = None
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    async def load(self):
+        row = await get_state(STATE_KEY)
+        return ujson.loads(row['value']) if row else None
+
+    async def save(self, state):
+        await set_state(STATE_KEY, ujson.dumps(state))
+
+    async def start(self, from_chat_id, message_id, admin_id):
+        """Новая рассылка с начала. False - уже идёт"""
+        current = await self.load()
+        if self.running or (current and current['status'] == 'running'): return False
+        state = {
+            'status': 'running', 'from_chat_id': from_chat_id, 'message_id': message_id,
+            'admin_id': admin_id, 'after': 0, 'sent': 0, 'blocked': 0, 'failed': 0,
+            'started_at': int(time.time()),
+        }
+        await self.save(state)
+        self._spawn(state)
+        return True
+
+    async def resume(self, force=False):
+        """Продолжить прерванную рассылку; force - ещё и остановленную вручную"""
+        state = await self.load()
+        if self.running or not state or state['status'] == 'done': return False
+        if state['status'] != 'running' and not force: return False
+        state['status'] = 'running'
+        await self.save(state)
+        logger.info(f"📣 Продолжаю рассылку после user_id {state['after']} (отправлено {state['sent']})")
+        self._spawn(state)
+        return True
+
+    async def stop(self):
+        """Флаг в базе: рассылку может вести другой воркер, он увидит его на границе страницы"""
+        state = await self.load()
+        if not state or state['status'] != 'running': return False
+        state['status'] = 'stopping'
+        await self.save(state)
+        return True
+
+    def _spawn(self, state):
+        self.task = asyncio.create_task(self._run(state))
+
+    async def _run(self, state):
+        # Все вызовы этой задачи - в хвост очереди Bot API, живые юзеры важнее
+        api_priority.set(API_PRIORITY_BULK)
+        async with advisory_lock(STATE_KEY) as locked:
+            if not locked:
+                logger.warning("📣 Рассылку уже ведёт другой процесс")
+                return
+            loop = asyncio.get_running_loop()
+            sem = asyncio.Semaphore(self.concurrency)
+            next_at = loop.time()
+            try:
+                async for page in iter_active_users(state['after'], self.page):
+                    sending = []
+                    for user_id in page:
+                        delay = next_at - loop.time()
+                        if delay > 0: await asyncio.sleep(delay)
+                        next_at = max(next_at, loop.time()) + self.interval
+                        await sem.acquire()
+                        task = asyncio.create_task(self._send(user_id, state))
+                        task.add_done_callback(lambda _: sem.release())
+                        sending.append(task)
+                    await asyncio.gather(*sending)
+                    state['after'] = page[-1]
+                    current = await self.load()
+                    if current and current['status'] != 'running':
+                        state['status'] = 'stopped'
+                        break
+                    await self.save(state)
+                else:
+                    state['status'] = 'done'
+            except Exception as e:
+                # Статус остаётся running: следующий старт продолжит с сохранённой страницы
+                logger.error(f"📣 Рассылка прервана: {e}")
+                return
+            await self.save(state)
+        logger.info(f"📣 Рассылка {state['status']}: {self.summary(state)}")
+        try: await self.bot.send_message(state['admin_id'], f"📣 Рассылка {state['status']}\n{self.summary(state)}")
+        except Exception: pass
+
+    async def _send(self, user_id, state):
+        try:
+            await self.bot.copy_message(
+                chat_id=user_id, from_chat_id=state['from_chat_id'], message_id=state['message_id']
+            )
+            state['sent'] += 1
+        except TelegramForbiddenError:
+            state['blocked'] += 1
+            await mark_inactive(user_id)
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower():
+                state['blocked'] += 1
+                await mark_inactive(user_id)
+            else:
+                state['failed'] += 1
+        except Exception:
+            state['failed'] += 1
+
+    @staticmethod
+    def summary(state):
+        return f"✅ {state['sent']} • 🚫 {state['blocked']} • ❌ {state['failed']} • до id {state['after']}"
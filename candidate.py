@@ -0,0 +1,62 @@
+from utils import format_plays
+
+class Candidate:
+    """Кандидат поиска - один объект на трек от движка до инлайн-выдачи.
+    Поля для показа считаются лениво и один раз (кандидаты живут в кэше поиска)."""
+    __slots__ = ('source', 'id', 'title', 'artist', 'playback_count', 'duration',
+                 'artwork_url', 'media_url_template', 'file_id', 'score',
+                 '_clean_title', '_duration_text', '_plays_text')
+
+    def __init__(self, source, id, title, artist, playback_count=0, duration=0,
+                 artwork_url=None, media_url_template=None, file_id=None):
+        self.source = source
+        self.id = id
+        self.title = title
+        self.artist = artist
+        self.playback_count = playback_count
+        self.duration = duration # мс
+        self.artwork_url = artwork_url
+        self.media_url_template = media_url_template # SC: progressive transcoding
+        self.file_id = file_id # уже залит в кэш-канал
+        self.score = 0
+        self._clean_title = self._duration_text = self._plays_text = None
+
+    # Компактная форма для общего кэша выдач: список полей без имён
+    PACKED = ('source', 'id', 'title', 'artist', 'playback_count', 'duration',
+              'artwork_url', 'media_url_template', 'score')
+
+    def pack(self):
+        return [getattr(self, name) for name in self.PACKED]
+
+    @classmethod
+    def unpack(cls, row):
+        *fields, score = row
+        candidate = cls(*fields)
+        candidate.score = score
+        return candidate
+
+    @property
+    def key(self): return (self.source, self.id)
+
+    @property
+    def clean_title(self):
+        if self._clean_title is None:
+            clean = self.title.replace(self.artist, '').strip(' -|:').replace('.mp3', '')
+            self._clean_title = clean or self.title
+        return self._clean_title
+
+    @property
+    def duration_text(self):
+        if self._duration_text is None:
+            m, s = divmod(self.duration // 1000, 60)
+            self._duration_text = f"{m:02d}:{s:02d}"
+        return self._duration_text
+
+    @property
+    def plays_text(self):
+        if self._plays_text is None:
+            self._plays_text = format_plays(self.playback_count)
+        return self._plays_text
+
+    def __repr__(self):
+        return f"Candidate({self.source}:{self.id} {self.artist!r} - {self.title!r})"
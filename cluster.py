@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import asyncpg
+import ujson
+import database
+from config import DATABASE_URL
+
+logger = logging.getLogger("CLUSTER")
+
+class Cluster:
+    """Шина между воркерами на LISTEN/NOTIFY Postgres. Без базы - тихо ничего не делает"""
+
+    def __init__(self):
+        self.conn = None # отдельное соединение: слушатель держит его постоянно
+        self.handlers = {} # канал -> callback(dict)
+
+    def on(self, channel, callback):
+        self.handlers[channel] = callback
+
+    async def start(self):
+        if not DATABASE_URL or not self.handlers: return
+        try:
+            self.conn = await asyncpg.connect(dsn=DATABASE_URL)
+            for channel in self.handlers:
+                await self.conn.add_listener(channel, self._dispatch)
+            logger.info(f"📡 Слушаю каналы: {', '.join(self.handlers)}")
+        except Exception as e:
+            logger.error(f"📡 LISTEN не поднялся: {e}")
+
+    def _dispatch(self, conn, pid, channel, payload):
+        try:
+            data = ujson.loads(payload)
+            if data.pop('origin', None) == database.INSTANCE_ID: return # своё эхо
+            self.handlers[channel](data)
+        except Exception as e:
+            logger.warning(f"📡 {channel}: кривое сообщение: {e}")
+
+    def publish(self, channel, data):
+        """Fire-and-forget: доставка - бонус, а не условие корректности"""
+        if not database.pool: return
+        payload = ujson.dumps({**data, 'origin': database.INSTANCE_ID})
+        task = asyncio.create_task(database.notify(channel, payload))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def close(self):
+        if self.conn: await self.conn.close()
+
+# --- СУПЕРВИЗОР ---
+
+def run_supervisor(workers, target):
+    """Держит workers процессов target(index); упавший перезапускается с паузой.
+    Порт они делят через SO_REUSEPORT, апдейты раздаёт вебхук."""
+    ctx = multiprocessing.get_context("spawn")
+    procs = {}
+    started = {}
+    restarts = {}
+    stopping = False
+
+    def spawn(index):
+        if stopping: return # SIGTERM пришёл, пока ждали бэкофф - новых воркеров не поднимаем
+        proc = ctx.Process(target=target, args=(index,), name=f"worker-{index}")
+        proc.start()
+        procs[index] = proc
+        started[index] = time.monotonic()
+        logger.info(f"👷 Воркер {index} запущен (pid {proc.pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for proc in procs.values():
+            if proc.is_alive(): os.kill(proc.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(workers): spawn(index)
+    while not stopping:
+        time.sleep(1)
+        for index, proc in list(procs.items()):
+            if proc.is_alive() or stopping: continue
+            # Проработал долго - значит, это не цикл падений, бэкофф с нуля
+            if time.monotonic() - started[index] > 60: restarts[index] = 0
+            delay = min(2 ** restarts.get(index, 0), 30)
+            logger.error(f"👷 Воркер {index} упал (код {proc.exitcode}), перезапуск через {delay}с")
+            time.sleep(delay)
+            restarts[index] = restarts.get(index, 0) + 1
+            spawn(index)
+    # Воркер мог стартовать уже после stop() (гонка с сигналом) - гасим всех, кто ещё жив
+    for proc in procs.values():
+        if proc.is_alive(): os.kill(proc.pid, signal.SIGTERM)
+    for proc in procs.values(): proc.join()
+    logger.info("👷 Все воркеры остановлены")
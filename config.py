@@ -12,18 +12,114 @@ DUMP_CHANNEL_ID = CACHE_CHANNEL_ID
 DUMP_CHANNEL_USERNAME = ""
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+
+# --- ПРИЁМ АПДЕЙТОВ ---
+UPDATES_MODE = os.getenv("UPDATES_MODE", "polling") # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") # одинаковый на всех инстансах за балансером
+WEBHOOK_MAX_CONCURRENT = 64 # апдейтов в обработке одновременно
+WEBHOOK_MAX_PENDING = 1000 # дальше отвечаем 503 и Telegram повторит позже
+WEBHOOK_DRAIN_TIMEOUT = 20 # сек на дообработку при остановке
+WORKERS = int(os.getenv("WORKERS", "1")) # >1: супервизор + N процессов на одном порту (только webhook)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100")) # при WORKERS > 1 воркер N отдаёт /metrics ещё и на METRICS_PORT + N (0 - выкл)
+
 FALLBACK_CLIENT_ID = os.getenv("FALLBACK_CLIENT_ID", "iY812d33303z321321")
+KEY_CHECK_INTERVAL = 600 # сек между фоновыми проверками client_id
+KEY_MAX_AGE = 6 * 3600 # обновляем заранее, даже если ключ ещё жив
+KEY_RETRY_INTERVAL = 30 # не скрапим чаще, если прошлая попытка провалилась
+KEY_SHARED_WAIT = 15 # сек ждём ключ, который обновляет другой воркер
 
 # --- LIMITS ---
-MAX_CONCURRENT_REQ = 4
 SEARCH_CANDIDATES_SC = 10
 SEARCH_CANDIDATES_YT = 10 
 INLINE_LIMIT = 10
+INLINE_DEBOUNCE = 0.35 # сек тишины от юзера перед поиском
 CACHE_TTL = 300
+SEARCH_CACHE_SIZE = 2048
+CANDIDATE_META_SIZE = 5000 # метаданные SC кандидатов из поиска для быстрого клика
+CANDIDATE_META_TTL = 600
+SEARCH_L2_TTL = 1800 # сек: выдача в общей таблице search_cache (переживает рестарт, общая для инстансов)
+SEARCH_L2_PURGE_INTERVAL = 600 # как часто чистим протухшие выдачи
+SEARCH_L2_TIMEOUT = 0.3 # сек на чтение search_cache: база тормозит - считаем промахом и идём в движки
+
+# --- АДАПТИВНЫЕ ЛИМИТЫ (на движок и на апстрим-хост) ---
+LIMIT_INITIAL = 4 # параллельных запросов на старте
+LIMIT_MIN = 1
+LIMIT_MAX = 32
+LIMIT_QUEUE = 8 # ждущих сверх лимита; дальше - сразу отказ
+LIMIT_LATENCY_TOLERANCE = 2.0 # латентность выше базовой во столько раз = перегрузка
+LIMIT_BACKOFF = 0.7 # множитель лимита при перегрузке
+
+# --- ДЕДЛАЙНЫ ПОИСКА ---
+SEARCH_DEADLINE = 2.5 # сек на весь поиск: дальше отвечаем тем, что успело прийти
+ENGINE_DEADLINES = {'SC': 5.0, 'YT': 7.0} # опоздавшие движки дорабатывают в фоне до этих пределов
+SEARCH_ENOUGH = 0 # отвечать сразу при N хороших кандидатах (0 - выкл)
+SEARCH_GOOD_SCORE = 300 # "хороший" = все слова запроса нашлись
+
+# --- ЗАГРУЗКИ ---
+TRANSFER_WORKERS = 4 # одновременных скачиваний/заливок
+TRANSFER_QUEUE = 50 # дальше юзер сразу получает "занято"
+UPLOAD_LEASE_TTL = 120 # сек: аренда загрузки трека между процессами
+UPLOAD_LEASE_POLL = 1.0 # как часто ждущий процесс проверяет file_cache
+
+# --- ЗАПИСЬ В БАЗУ ---
+WRITE_BATCH = 200 # строк в пачке: набралось - сбрасываем сразу
+WRITE_INTERVAL = 0.5 # сек: иначе сбрасываем по таймеру
+WRITE_WAIT = 3.0 # сек: сколько аренда загрузки ждёт записи своей строки (юзер не ждёт)
+
+# --- BOT API ---
+BOTAPI_RATE = 25 # сообщений в секунду на бота (лимит Telegram ~30), делится между WORKERS; инлайн-ответы и колбэки не в счёт
+BOTAPI_CHAT_INTERVAL = 1.0 # сек между вызовами в один чат / одно инлайн-сообщение
+BOTAPI_MAX_RETRIES = 3 # сколько раз переждать 429, прежде чем сдаться
+BOTAPI_MAX_RETRY_AFTER = 60 # сек: дольше ждать нет смысла - юзер уже ушёл
+
+# --- РАССЫЛКА ---
+BROADCAST_RATE = 20 # сообщений в секунду: запас под живых юзеров до BOTAPI_RATE (при WORKERS > 1 - до его доли)
+BROADCAST_PAGE = 200 # юзеров на страницу; прогресс сохраняется после каждой
+BROADCAST_CONCURRENCY = 10 # одновременных отправок (чтобы задержка сети не съедала темп)
+
+# --- КЭШ FILE_ID В ПАМЯТИ ---
+FILE_CACHE_L1_SIZE = 20000 # (source, id) -> file_id: клик по горячему треку без базы
+FILE_CACHE_NEG_TTL = 30 # сек помним "нет в базе" (другой воркер мог залить - не дольше)
+FILE_CACHE_WARM = int(os.getenv("FILE_CACHE_WARM", 5000)) # самых востребованных строк при старте (0 - выкл)
+DB_POOL_MIN = 2 # тёплых соединений: первый клик не ждёт коннекта
+
+# --- ТРАССИРОВКА ---
+TRACE_FILE = os.getenv("TRACE_FILE", "") # jsonl; пусто - трассы только в памяти для /traces
+TRACE_FILE_MAX = 50 * 1024 * 1024 # байт: больше - переименовываем в .1 и начинаем заново
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", 0.05)) # доля обычных трасс в файл
+TRACE_SLOW = 2.0 # сек: трассы медленнее пишутся всегда
+TRACE_KEEP = 2000 # последних трасс в памяти
+TRACE_WINDOW = 600 # сек: окно для /traces и связи клика с инлайн-запросом
+
+# --- ОТЛАДКА ---
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "") # Bearer для /debug/*; пусто - эндпоинты выключены
+PROFILE_MAX_SECONDS = 60 # потолок одного CPU профиля
+PROFILE_INTERVAL = 0.005 # сек между сэмплами стека
+LOOP_LAG_INTERVAL = 0.1 # сек: шаг замера лага event loop
+
+# --- ПРЕФЕТЧ ---
+PREFETCH_MODE = os.getenv("PREFETCH_MODE", "off") # off | resolve | upload
+PREFETCH_TOP_K = 2 # сколько верхних результатов готовить (для самых популярных запросов)
+PREFETCH_MIN_POPULARITY = 3 # запрос должен встретиться столько раз за 10 минут
+PREFETCH_PER_MINUTE = 30 # глобальный бюджет префетчей
+PREFETCH_MAX_INFLIGHT = 4
+PREFETCH_WINDOW = 600 # сек: не кликнули за это время - префетч потрачен зря
 
 PIPED_MIRRORS = [
     "https://api.piped.private.coffee"
 ]
+# --- ЗДОРОВЬЕ ЗЕРКАЛ ---
+MIRROR_EWMA_ALPHA = 0.2
+MIRROR_FAIL_THRESHOLD = 3 # ошибок подряд до выключения зеркала
+MIRROR_COOLDOWN = 30 # сек; удваивается при неудачной пробе
+MIRROR_COOLDOWN_MAX = 600
+MIRROR_PROBE_INTERVAL = 10
+MIRROR_PROBE_PATH = "/healthcheck"
+MIRROR_HEDGE_MIN = 0.3 # не дублируем запрос раньше, чем через столько сек
+MIRROR_HEDGE_DEFAULT = 1.5 # порог hedge, пока не набрали статистику для p90
+
 # --- FILTERS ---
 BAD_CHARS_RE = re.compile(r'[\u0590-\u05ff\u0600-\u06ff\u4e00-\u9fff]')
 SEARCH_STOP_WORDS = frozenset({
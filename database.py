@@ -1,91 +1,406 @@
+import asyncio
 import asyncpg
-from config import DATABASE_URL
+import os
+import socket
+from contextlib import asynccontextmanager
+from cachetools import LRUCache, TTLCache
+from config import (
+    DATABASE_URL, UPLOAD_LEASE_TTL, WRITE_BATCH, WRITE_INTERVAL, WRITE_WAIT,
+    FILE_CACHE_L1_SIZE, FILE_CACHE_NEG_TTL, DB_POOL_MIN
+)
+from writebehind import WriteBehind
+import tracing
 
 pool = None
+# Владелец аренд загрузки: уникален для процесса
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# L1 перед file_cache: file_id не протухает, а "нет в базе" помним недолго
+file_ids = LRUCache(FILE_CACHE_L1_SIZE) # uniq_id -> (file_id, message_id)
+missing = TTLCache(FILE_CACHE_L1_SIZE // 4, FILE_CACHE_NEG_TTL)
+file_cache_stats = {'l1': 0, 'negative': 0, 'db': 0}
+cache_written = {} # uniq_id -> future записи свежей строки file_cache, пока не записана
+
+# Поднимать при любой правке _migrate: базы с текущей версией DDL пропускают
+SCHEMA_VERSION = 1
+
+GET_FILE_SQL = "SELECT file_id, message_id FROM file_cache WHERE uniq_id = $1"
+
+async def _init_conn(conn):
+    # Готовим запрос клика заранее: asyncpg держит его в кэше выражений соединения
+    try: await conn.fetchrow(GET_FILE_SQL, "")
+    except Exception: pass # таблицы ещё нет - первый запуск
 
 async def init_db():
     global pool
     try:
         pool = await asyncpg.create_pool(
             dsn=DATABASE_URL,
-            min_size=0, 
+            min_size=DB_POOL_MIN, 
             max_size=6,
             max_inactive_connection_lifetime=300,
-            command_timeout=10
+            command_timeout=10,
+            init=_init_conn
         )
         
         async with pool.acquire() as connection:
-            # Основная таблица юзеров
-            await connection.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    is_active BOOLEAN DEFAULT TRUE
-                );
-                CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active);
-            """)
-
-            # Таблица кэша
-            await connection.execute("""
-                CREATE TABLE IF NOT EXISTS file_cache (
-                    uniq_id TEXT PRIMARY KEY, 
-                    file_id TEXT NOT NULL
-                );
-            """)
-            
-            # МИГРАЦИЯ: Добавляем колонку message_id, если её нет (чтобы старая база не сломалась)
-            try:
-                await connection.execute("ALTER TABLE file_cache ADD COLUMN IF NOT EXISTS message_id BIGINT;")
-            except Exception as e:
-                print(f"⚠️ Migration notice: {e}")
-
-            print("✅ Database connected & Updated")
+            # Схема этой версии или новее - один SELECT вместо пачки DDL на каждом старте.
+            # Новее бывает при раскатке: старая сборка не трогает схему и маркер новой
+            version = await _schema_version(connection)
+            if version is not None and version >= SCHEMA_VERSION:
+                print(f"✅ Database connected (schema v{version}, build v{SCHEMA_VERSION})")
+            else:
+                # Воркеры стартуют разом: DDL гоняет один, остальные ждут и видят готовую схему
+                await connection.execute("SELECT pg_advisory_lock(hashtext('schema'))")
+                try:
+                    version = await _schema_version(connection)
+                    if (version is None or version < SCHEMA_VERSION) and await _migrate(connection):
+                        await connection.execute(
+                            """
+                            INSERT INTO bot_state (key, value) VALUES ('schema_version', $1)
+                            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()
+                            WHERE bot_state.value::int < EXCLUDED.value::int
+                            """,
+                            str(SCHEMA_VERSION)
+                        )
+                finally:
+                    await connection.execute("SELECT pg_advisory_unlock(hashtext('schema'))")
+                print("✅ Database connected & Updated")
+
+        cache_writes.start()
+        user_writes.start()
+        hit_writes.start()
+        search_writes.start()
+        inactive_writes.start()
     except Exception as e:
         print(f"❌ DB Error: {e}")
 
+async def _schema_version(conn):
+    try:
+        value = await conn.fetchval("SELECT value FROM bot_state WHERE key = 'schema_version'")
+    except asyncpg.UndefinedTableError:
+        return None # совсем новая база
+    return int(value) if value else None
+
+async def _migrate(connection):
+    # Основная таблица юзеров
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            is_active BOOLEAN DEFAULT TRUE
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active);
+        -- Рассылка идёт по активным страницами по user_id
+        CREATE INDEX IF NOT EXISTS idx_users_active_id ON users(user_id) WHERE is_active;
+    """)
+
+    # Таблица кэша
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS file_cache (
+            uniq_id TEXT PRIMARY KEY, 
+            file_id TEXT NOT NULL
+        );
+    """)
+    
+    # Аренда загрузок: один процесс качает трек, остальные ждут его file_id
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS upload_leases (
+            uniq_id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+    """)
+
+    # Общий кэш выдач поиска: ранжированные кандидаты по нормализованному запросу
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS search_cache (
+            query_key TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_cache_expires ON search_cache(expires_at);
+    """)
+
+    # Служебные ключ-значение (client_id SC и т.п.), переживают рестарт
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    
+    # МИГРАЦИЯ: Добавляем колонку message_id, если её нет (чтобы старая база не сломалась)
+    try:
+        await connection.execute("ALTER TABLE file_cache ADD COLUMN IF NOT EXISTS message_id BIGINT;")
+        # Метаданные для локального поиска по уже залитым трекам
+        await connection.execute("""
+            ALTER TABLE file_cache
+                ADD COLUMN IF NOT EXISTS title TEXT,
+                ADD COLUMN IF NOT EXISTS artist TEXT,
+                ADD COLUMN IF NOT EXISTS duration INT;
+        """)
+        # Сколько раз трек отдавали из кэша - для прогрева L1 при старте
+        await connection.execute("ALTER TABLE file_cache ADD COLUMN IF NOT EXISTS hits INT NOT NULL DEFAULT 0;")
+    except Exception as e:
+        print(f"⚠️ Migration notice: {e}")
+        return False # версию не записываем: следующий старт попробует снова
+    return True
+
 # ОБНОВЛЕННЫЕ ФУНКЦИИ КЭША
 
-async def get_cached_info(source: str, item_id: str):
-    """Возвращает (file_id, message_id)"""
+async def get_cached_info(source: str, item_id: str, fresh: bool = False):
+    """Возвращает {'file_id', 'message_id'} или None.
+    fresh=True - мимо L1 в базу (ждём, пока трек зальёт другой процесс)"""
     if not pool: return None
     uniq_id = f"{source}_{item_id}"
+    found = file_ids.get(uniq_id) or cache_writes.get(uniq_id)
+    if found:
+        file_cache_stats['l1'] += 1
+        tracing.tag('file_cache', 'l1')
+        hit_writes.add(uniq_id)
+        return {'file_id': found[0], 'message_id': found[1]}
+    if not fresh and uniq_id in missing:
+        file_cache_stats['negative'] += 1
+        tracing.tag('file_cache', 'negative')
+        return None
+    file_cache_stats['db'] += 1
+    tracing.tag('file_cache', 'db')
     try:
-        async with pool.acquire() as conn:
-            # Возвращаем всю строку
-            row = await conn.fetchrow("SELECT file_id, message_id FROM file_cache WHERE uniq_id = $1", uniq_id)
-            if row:
-                return dict(row) # {'file_id': '...', 'message_id': 123}
-            return None
+        with tracing.span('file_cache_db'):
+            async with pool.acquire() as conn:
+                row = await conn.fetchrow(GET_FILE_SQL, uniq_id)
     except: return None
+    if not row:
+        missing[uniq_id] = True
+        return None
+    file_ids[uniq_id] = (row['file_id'], row['message_id'])
+    missing.pop(uniq_id, None)
+    hit_writes.add(uniq_id)
+    return dict(row) # {'file_id': '...', 'message_id': 123}
+
+async def warm_file_cache(limit: int):
+    """Заливаем в L1 самые востребованные треки, чтобы первые клики после рестарта не шли в базу"""
+    if not pool or not limit: return
+    try:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT uniq_id, file_id, message_id FROM file_cache ORDER BY hits DESC LIMIT $1",
+                min(limit, FILE_CACHE_L1_SIZE)
+            )
+    except Exception as e:
+        print(f"⚠️ L1 warm failed: {e}")
+        return
+    # С конца: самые горячие должны оказаться свежими в LRU.
+    # Прогрев идёт в фоне, пока бот уже работает: свежие заливки не перетираем
+    for row in reversed(rows):
+        if row['uniq_id'] not in file_ids:
+            file_ids[row['uniq_id']] = (row['file_id'], row['message_id'])
+    print(f"✅ L1 file cache warmed: {len(rows)}")
+
+async def save_cached_info(source: str, item_id: str, file_id: str, message_id: int,
+                           title: str = None, artist: str = None, duration: int = None):
+    """Сохраняем file_id и message_id (+ метаданные для локального поиска).
+    Пишется пачкой в фоне и без ожидания: этот процесс видит file_id сразу (L1),
+    а записи ждёт только снятие аренды загрузки (wait_cache_written)"""
+    if not pool: return
+    uniq_id = f"{source}_{item_id}"
+    file_ids[uniq_id] = (file_id, message_id)
+    missing.pop(uniq_id, None)
+    written = cache_written[uniq_id] = cache_writes.put(uniq_id, (file_id, message_id, title, artist, duration))
+    written.add_done_callback(lambda f: cache_written.pop(uniq_id) if cache_written.get(uniq_id) is f else None)
 
-async def save_cached_info(source: str, item_id: str, file_id: str, message_id: int):
-    """Сохраняем file_id и message_id"""
+async def wait_cache_written(source: str, item_id: str):
+    """Другие процессы узнают file_id только из базы: ждём записи строки не дольше WRITE_WAIT"""
+    written = cache_written.get(f"{source}_{item_id}")
+    if written is None: return
+    try: await asyncio.wait_for(asyncio.shield(written), WRITE_WAIT)
+    except asyncio.TimeoutError: pass
+
+async def _flush_cache(rows):
+    async with pool.acquire() as conn:
+        await conn.executemany(
+            """
+            INSERT INTO file_cache (uniq_id, file_id, message_id, title, artist, duration) 
+            VALUES ($1, $2, $3, $4, $5, $6) 
+            ON CONFLICT (uniq_id) DO UPDATE 
+            SET file_id = EXCLUDED.file_id, message_id = EXCLUDED.message_id,
+                title = COALESCE(EXCLUDED.title, file_cache.title),
+                artist = COALESCE(EXCLUDED.artist, file_cache.artist),
+                duration = COALESCE(EXCLUDED.duration, file_cache.duration)
+            """,
+            [(uniq_id, *row) for uniq_id, row in rows.items()]
+        )
+
+async def _flush_hits(counts):
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """
+            UPDATE file_cache SET hits = file_cache.hits + v.n
+            FROM unnest($1::text[], $2::int[]) AS v(uniq_id, n)
+            WHERE file_cache.uniq_id = v.uniq_id
+            """,
+            list(counts), list(counts.values())
+        )
+
+# ОБЩИЙ КЭШ ВЫДАЧ
+
+async def get_search_cache(query_key: str):
+    """payload (json) непротухшей выдачи или None"""
+    if not pool: return None
+    pending = search_writes.get(query_key)
+    if pending: return pending[0]
+    try:
+        async with pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT payload FROM search_cache WHERE query_key = $1 AND expires_at > now()", query_key
+            )
+    except Exception: return None
+
+def save_search_cache(query_key: str, payload: str, ttl: int):
+    """Без ожидания: выдача уйдёт в базу ближайшей пачкой"""
     if not pool: return
+    search_writes.put(query_key, (payload, ttl))
+
+async def _flush_searches(rows):
+    async with pool.acquire() as conn:
+        await conn.executemany(
+            """
+            INSERT INTO search_cache (query_key, payload, expires_at)
+            VALUES ($1, $2, now() + make_interval(secs => $3))
+            ON CONFLICT (query_key) DO UPDATE
+            SET payload = EXCLUDED.payload, expires_at = EXCLUDED.expires_at
+            """,
+            [(key, payload, float(ttl)) for key, (payload, ttl) in rows.items()]
+        )
+
+async def purge_search_cache():
+    """Удаляет протухшие выдачи одним запросом, возвращает сколько"""
+    if not pool: return 0
+    async with pool.acquire() as conn:
+        status = await conn.execute("DELETE FROM search_cache WHERE expires_at < now()")
+    return int(status.split()[-1])
+
+async def iter_cached_tracks():
+    """Стримит треки с метаданными серверным курсором (без загрузки всей таблицы в память)"""
+    if not pool: return
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            async for row in conn.cursor(
+                "SELECT uniq_id, file_id, title, artist, duration FROM file_cache WHERE title IS NOT NULL",
+                prefetch=1000
+            ):
+                yield row
+
+# АРЕНДА ЗАГРУЗОК
+
+async def acquire_upload_lease(source: str, item_id: str):
+    """True - качаем мы. Просроченную чужую аренду перехватываем. Без базы - всегда True"""
+    if not pool: return True
     uniq_id = f"{source}_{item_id}"
     try:
         async with pool.acquire() as conn:
-            await conn.execute(
+            owner = await conn.fetchval(
                 """
-                INSERT INTO file_cache (uniq_id, file_id, message_id) 
-                VALUES ($1, $2, $3) 
-                ON CONFLICT (uniq_id) DO UPDATE 
-                SET file_id = EXCLUDED.file_id, message_id = EXCLUDED.message_id
+                INSERT INTO upload_leases (uniq_id, owner, expires_at)
+                VALUES ($1, $2, now() + make_interval(secs => $3))
+                ON CONFLICT (uniq_id) DO UPDATE
+                SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+                WHERE upload_leases.expires_at < now() OR upload_leases.owner = EXCLUDED.owner
+                RETURNING owner
                 """,
-                uniq_id, file_id, message_id
+                uniq_id, INSTANCE_ID, float(UPLOAD_LEASE_TTL)
             )
-    except: pass
+            return owner is not None
+    except Exception: return True # база лежит - лучше дубль, чем зависший клик
 
-# ЮЗЕР ФУНКЦИИ
+async def renew_upload_lease(source: str, item_id: str):
+    """Продлить свою аренду на UPLOAD_LEASE_TTL. False - её уже перехватили"""
+    if not pool: return True
+    uniq_id = f"{source}_{item_id}"
+    try:
+        async with pool.acquire() as conn:
+            status = await conn.execute(
+                """
+                UPDATE upload_leases SET expires_at = now() + make_interval(secs => $3)
+                WHERE uniq_id = $1 AND owner = $2
+                """,
+                uniq_id, INSTANCE_ID, float(UPLOAD_LEASE_TTL)
+            )
+            return status != "UPDATE 0"
+    except Exception: return True # не смогли продлить - не значит, что потеряли
 
-async def add_user(user_id: int):
+async def release_upload_lease(source: str, item_id: str):
     if not pool: return
+    uniq_id = f"{source}_{item_id}"
     try:
-        async with pool.acquire() as connection:
-            await connection.execute(
-                "INSERT INTO users (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", 
-                user_id
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM upload_leases WHERE uniq_id = $1 AND owner = $2", uniq_id, INSTANCE_ID)
+    except Exception: pass
+
+# КООРДИНАЦИЯ ВОРКЕРОВ
+
+@asynccontextmanager
+async def advisory_lock(name: str):
+    """Сессионный advisory lock на время блока. yield False - держит кто-то другой.
+    Держится долго (вся рассылка), поэтому на своём соединении, как у Cluster, а не на слоте пула.
+    Процесс умер - соединение закрылось, и лок освободился сам"""
+    if not pool:
+        yield True
+        return
+    conn = await asyncpg.connect(dsn=DATABASE_URL)
+    try:
+        got = await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", name)
+        yield got
+    finally:
+        await conn.close() # закрытие сессии снимает и лок
+
+async def notify(channel: str, payload: str):
+    if not pool: return
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+# СЛУЖЕБНОЕ СОСТОЯНИЕ
+
+async def get_state(key: str):
+    """Возвращает {'value': ..., 'updated_at': datetime} или None"""
+    if not pool: return None
+    try:
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT value, updated_at FROM bot_state WHERE key = $1", key)
+            return dict(row) if row else None
+    except Exception: return None
+
+async def set_state(key: str, value: str):
+    if not pool: return
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO bot_state (key, value) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()
+                """,
+                key, value
             )
     except Exception: pass
 
+# ЮЗЕР ФУНКЦИИ
+
+async def add_user(user_id: int):
+    """Не ждёт базу: юзер уйдёт в ближайшую пачку. Вернувшийся юзер снова активен"""
+    if not pool: return
+    if user_id not in user_writes: user_writes.put(user_id)
+
+async def _flush_users(rows):
+    async with pool.acquire() as connection:
+        await connection.execute(
+            """
+            INSERT INTO users (user_id) SELECT unnest($1::bigint[])
+            ON CONFLICT (user_id) DO UPDATE SET is_active = TRUE WHERE NOT users.is_active
+            """,
+            list(rows)
+        )
+
 async def get_users_count():
     if not pool: return 0
     try:
@@ -93,13 +408,44 @@ async def get_users_count():
             return await conn.fetchval("SELECT COUNT(*) FROM users WHERE is_active = TRUE")
     except: return 0
 
-async def get_active_users_cursor():
-    if not pool: return None
-    return pool.acquire()
+async def iter_active_users(after: int = 0, page: int = 500):
+    """Активные юзеры по возрастанию user_id страницами по ключу: память не зависит от размера
+    таблицы, соединение между страницами не держим"""
+    if not pool: return
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM users WHERE is_active AND user_id > $1 ORDER BY user_id LIMIT $2",
+                after, page
+            )
+        if not rows: return
+        page_ids = [row['user_id'] for row in rows]
+        yield page_ids
+        after = page_ids[-1]
 
 async def mark_inactive(user_id: int):
+    """Не ждёт базу: заблокировавшие бота копятся и гасятся одним UPDATE"""
     if not pool: return
-    try:
-        async with pool.acquire() as connection:
-            await connection.execute("UPDATE users SET is_active = FALSE WHERE user_id = $1", user_id)
-    except: pass
\ No newline at end of file
+    inactive_writes.put(user_id)
+
+async def _flush_inactive(rows):
+    async with pool.acquire() as connection:
+        await connection.execute(
+            "UPDATE users SET is_active = FALSE WHERE user_id = ANY($1::bigint[])", list(rows)
+        )
+
+# Записи копятся и уходят пачками, а не по одному INSERT на загрузку/юзера
+cache_writes = WriteBehind("file_cache", _flush_cache, WRITE_BATCH, WRITE_INTERVAL)
+user_writes = WriteBehind("users", _flush_users, WRITE_BATCH, WRITE_INTERVAL)
+# Счётчики популярности: не критичны, сбрасываем редко
+hit_writes = WriteBehind("hits", _flush_hits, WRITE_BATCH, WRITE_INTERVAL * 20)
+search_writes = WriteBehind("search_cache", _flush_searches, WRITE_BATCH, WRITE_INTERVAL * 4)
+inactive_writes = WriteBehind("inactive", _flush_inactive, WRITE_BATCH, WRITE_INTERVAL * 4)
+
+async def flush_writes():
+    """При остановке: записать всё из буферов"""
+    await cache_writes.close()
+    await user_writes.close()
+    await hit_writes.close()
+    await search_writes.close()
+    await inactive_writes.close()
@@ -0,0 +1,36 @@
+import asyncio
+
+class QueryDebouncer:
+    """Per-user дебаунс: новый запрос юзера отменяет его старый (в ожидании или в работе)"""
+    __slots__ = ('delay', 'pending', 'stats')
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.pending = {}  # user_id -> Task
+        self.stats = {'started': 0, 'superseded': 0}
+
+    async def run(self, user_id: int, factory):
+        """Ждёт паузу и выполняет factory(). None - если запрос вытеснен более новым"""
+        prev = self.pending.get(user_id)
+        if prev is not None and not prev.done():
+            self.stats['superseded'] += 1
+            prev.cancel()
+
+        task = asyncio.create_task(self._delayed(factory))
+        self.pending[user_id] = task
+        try:
+            # wait, а не await: отмена task не должна пробрасываться в хендлер
+            await asyncio.wait((task,))
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self.pending.get(user_id) is task: del self.pending[user_id]
+
+        if task.cancelled(): return None
+        return task.result()
+
+    async def _delayed(self, factory):
+        if self.delay > 0: await asyncio.sleep(self.delay)
+        self.stats['started'] += 1
+        return await factory()
@@ -2,14 +2,27 @@ import asyncio
 import aiohttp
 import ujson
 import logging
-import gc
-import random
 import re
+import time
+from cachetools import TTLCache
 from config import (
-    MAX_CONCURRENT_REQ, SEARCH_CANDIDATES_SC, SEARCH_CANDIDATES_YT,
-    PIPED_MIRRORS, FALLBACK_CLIENT_ID, BAD_CHARS_RE
+    SEARCH_CANDIDATES_SC, SEARCH_CANDIDATES_YT,
+    PIPED_MIRRORS, FALLBACK_CLIENT_ID, BAD_CHARS_RE,
+    CACHE_TTL, SEARCH_CACHE_SIZE, CANDIDATE_META_SIZE, CANDIDATE_META_TTL,
+    SEARCH_L2_TTL, SEARCH_L2_PURGE_INTERVAL, SEARCH_L2_TIMEOUT,
+    SEARCH_DEADLINE, ENGINE_DEADLINES, SEARCH_ENOUGH, SEARCH_GOOD_SCORE,
+    KEY_CHECK_INTERVAL, KEY_MAX_AGE, KEY_RETRY_INTERVAL, KEY_SHARED_WAIT
 )
-from utils import calculate_score
+from database import (
+    get_state, set_state, advisory_lock, get_search_cache, save_search_cache, purge_search_cache
+)
+from mirrors import MirrorPool
+from limiter import AdaptiveLimiter, LimiterFull, hosts
+from metrics import ENGINE_SECONDS, SC_KEY_EVENTS
+import tracing
+from candidate import Candidate
+from ranking import QueryRanker, by_score
+from utils import normalize_query
 
 # Настраиваем логгер
 logger = logging.getLogger("ENGINE")
@@ -18,251 +31,574 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "Referer": "https://soundcloud.com/"
 }
+CLIENT_ID_RE = re.compile(r'client_id:"([a-zA-Z0-9]{32})"')
+
+SC_API = "https://api-v2.soundcloud.com"
+KEY_STATE = "sc_client_id"
 
 class KeyManager:
     def __init__(self, session):
         self.session = session
         self.client_id = FALLBACK_CLIENT_ID
+        self.refreshed_at = 0.0 # unix time, когда ключ последний раз получен/подтверждён
+        self.last_attempt = 0.0
+        self.refresh_task = None # общий для всех, кто словил 401 (single-flight)
+        self.watch_task = None
+        self.publish = None # callback(client_id): рассказать другим воркерам о новом ключе
+
+    async def load(self):
+        """Поднимаем последний рабочий ключ из базы, чтобы не ждать скрапинга на старте"""
+        saved = await get_state(KEY_STATE)
+        if saved:
+            self.client_id = saved['value']
+            self.refreshed_at = saved['updated_at'].timestamp()
+            logger.info(f"🔑 SC: Ключ из базы: {self.client_id}")
+
+    def start(self):
+        if self.watch_task is None:
+            self.watch_task = asyncio.create_task(self._watch())
+
+    async def refresh(self, stale_id=None):
+        """Все конкурентные вызовы ждут одно обновление. stale_id - ключ, который словил 401:
+        если его уже заменили, второй раз не качаем."""
+        if stale_id is not None and stale_id != self.client_id:
+            return self.client_id
+        if self.refresh_task is None:
+            if time.time() - self.last_attempt < KEY_RETRY_INTERVAL:
+                return self.client_id # недавно пробовали и не вышло - не долбим SC
+            SC_KEY_EVENTS.inc('refresh')
+            self.refresh_task = asyncio.create_task(self._refresh_shared(stale_id))
+            self.refresh_task.add_done_callback(self._refresh_done)
+        await asyncio.shield(self.refresh_task)
+        return self.client_id
+
+    def _refresh_done(self, task):
+        self.refresh_task = None
+
+    async def _refresh_shared(self, stale_id):
+        """Между процессами: ключ качает один воркер (advisory lock), остальные берут его из базы"""
+        saved = await get_state(KEY_STATE)
+        if saved and stale_id and saved['value'] != stale_id:
+            self.adopt(saved['value'])
+            return True
+        async with advisory_lock(KEY_STATE) as got:
+            if got: return await self.fetch_new_key()
+        logger.info("🔑 SC: Ключ уже обновляет другой воркер, жду...")
+        for _ in range(KEY_SHARED_WAIT):
+            await asyncio.sleep(1)
+            saved = await get_state(KEY_STATE)
+            if saved and saved['value'] != (stale_id or self.client_id):
+                self.adopt(saved['value'])
+                return True
+        return False
+
+    def adopt(self, client_id):
+        """Ключ, полученный другим воркером (из базы или NOTIFY)"""
+        if client_id == self.client_id: return
+        self.client_id = client_id
+        self.refreshed_at = time.time()
+        SC_KEY_EVENTS.inc('adopted')
+        logger.info(f"🔑 SC: Новый ключ от другого воркера: {client_id}")
 
     async def fetch_new_key(self):
-        gc.collect()
+        self.last_attempt = time.time()
         logger.info("🔑 SC: Запускаю обновление ключа...")
         try:
             async with self.session.get("https://soundcloud.com/discover", timeout=4) as resp:
                 if resp.status != 200: 
                     logger.error(f"🔑 SC: Ошибка главной страницы (Status {resp.status})")
-                    return
+                    return False
                 text = await resp.text()
             
             js_urls = re.findall(r'src="(https://[^"]+/assets/[^"]+\.js)"', text)
             if not js_urls: 
                 logger.error("🔑 SC: Не нашел JS файлы на странице")
-                return
+                return False
             
             logger.info(f"🔑 SC: Найдено {len(js_urls)} скриптов. Проверяю последние...")
-            
-            for url in js_urls[-3:]:
-                try:
-                    async with self.session.get(url, timeout=3) as js_resp:
-                        if js_resp.status != 200: continue
-                        content = await js_resp.text()
-                        match = re.search(r'client_id:"([a-zA-Z0-9]{32})"', content)
-                        if match:
-                            self.client_id = match.group(1)
-                            logger.info(f"🔑 SC: ✅ УСПЕХ! Новый ключ: {self.client_id}")
-                            return
-                except Exception as e:
-                    logger.warning(f"🔑 SC: Ошибка проверки скрипта: {e}")
+
+            # Скрипты качаем параллельно, берём первый найденный ключ
+            tasks = [asyncio.create_task(self._scan_script(url)) for url in js_urls[-3:]]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    client_id = await next_done
+                    if client_id:
+                        await self._set_key(client_id)
+                        SC_KEY_EVENTS.inc('scraped')
+                        logger.info(f"🔑 SC: ✅ УСПЕХ! Новый ключ: {self.client_id}")
+                        return True
+            finally:
+                for t in tasks: t.cancel()
             logger.error("🔑 SC: Ключ так и не найден в скриптах")
         except Exception as e:
             logger.error(f"🔑 SC Key Error: {e}")
+        return False
+
+    async def _scan_script(self, url):
+        try:
+            async with self.session.get(url, timeout=3) as js_resp:
+                if js_resp.status != 200: return None
+                content = await js_resp.text()
+            match = CLIENT_ID_RE.search(content)
+            return match.group(1) if match else None
+        except Exception as e:
+            logger.warning(f"🔑 SC: Ошибка проверки скрипта: {e}")
+            return None
+
+    async def _set_key(self, client_id):
+        self.client_id = client_id
+        self.refreshed_at = time.time()
+        await set_state(KEY_STATE, client_id)
+        if self.publish: self.publish(client_id)
+
+    async def validate(self):
+        """False только при явном 401; сетевые ошибки ключ не компрометируют"""
+        params = {"q": "a", "limit": 1, "client_id": self.client_id}
+        try:
+            async with self.session.get(f"{SC_API}/search/tracks", params=params, timeout=4) as resp:
+                return resp.status != 401
+        except Exception:
+            return True
+
+    async def _watch(self):
+        # Проверяем ключ заранее, чтобы 401 ловил фон, а не юзерский поиск
+        while True:
+            try:
+                if time.time() - self.refreshed_at >= KEY_MAX_AGE:
+                    logger.info("🔑 SC: Ключ старый, обновляю заранее")
+                    await self.refresh()
+                elif not await self.validate():
+                    logger.warning("🔑 SC: Фоновая проверка: ключ протух")
+                    await self.refresh(self.client_id)
+            except Exception as e:
+                logger.error(f"🔑 SC Watch Error: {e}")
+            await asyncio.sleep(KEY_CHECK_INTERVAL)
     
     def get_id(self): return self.client_id
 
 class SoundCloudEngine:
-    __slots__ = ('session', 'sem', 'key_manager')
+    __slots__ = ('session', 'limiter', 'key_manager', 'meta')
     def __init__(self, session, key_manager):
         self.session = session
-        self.sem = asyncio.Semaphore(MAX_CONCURRENT_REQ)
+        self.limiter = AdaptiveLimiter("SC", metric=ENGINE_SECONDS)
         self.key_manager = key_manager
+        # id трека -> кандидат из поиска: на клике не нужно повторно ходить в /tracks/{id}
+        self.meta = TTLCache(maxsize=CANDIDATE_META_SIZE, ttl=CANDIDATE_META_TTL)
+
+    async def _get_json(self, url, params=None, timeout=4, priority=False):
+        """GET с текущим client_id. На 401 ждёт общее обновление ключа и повторяет один раз.
+        Возвращает (status, data); data = None, если status != 200. priority - для кликов (см. AdaptiveLimiter)"""
+        params = dict(params or {})
+        for attempt in (0, 1):
+            client_id = self.key_manager.get_id()
+            params['client_id'] = client_id
+            async with hosts.for_url(url).slot(priority) as slot:
+                async with self.session.get(url, params=params, timeout=timeout) as resp:
+                    status = resp.status
+                    if status == 429 or status >= 500: slot.fail()
+                    data = await resp.json(loads=ujson.loads) if status == 200 else None
+            # Ключ обновляем уже без слота хоста: ожидание может быть долгим
+            if status == 401 and not attempt:
+                SC_KEY_EVENTS.inc('401')
+                logger.warning("☁️ SC: 401 Unauthorized -> Обновляю ключ")
+                await self.key_manager.refresh(client_id)
+                continue
+            return status, data
 
     async def search_raw(self, query: str):
-        client_id = self.key_manager.get_id()
-        params = {"q": query, "client_id": client_id, "limit": SEARCH_CANDIDATES_SC, "app_version": "1699953100"}
+        params = {"q": query, "limit": SEARCH_CANDIDATES_SC, "app_version": "1699953100"}
         
-        async with self.sem:
-            try:
-                # logger.info(f"☁️ SC: Search '{query}'")
-                async with self.session.get("https://api-v2.soundcloud.com/search/tracks", params=params, timeout=4) as resp:
-                    
-                    if resp.status == 401:
-                        logger.warning("☁️ SC: 401 Unauthorized -> Обновляю ключ")
-                        await self.key_manager.fetch_new_key()
-                        return [] # Юзер попробует еще раз
-                    
-                    if resp.status != 200: 
-                        logger.error(f"☁️ SC: Ошибка API {resp.status}")
-                        return []
-                    
-                    data = await resp.json(loads=ujson.loads)
-                    collection = data.get('collection', [])
-                    
-                    # logger.info(f"☁️ SC: Найдено {len(collection)} сырых треков")
-                    
-                    candidates = []
-                    for item in collection:
-                        if not item.get('streamable'): continue
-                        artwork = item.get('artwork_url') or item.get('user', {}).get('avatar_url')
-                        if artwork: artwork = artwork.replace('large', 't500x500')
-                        
-                        prog_url = next((t['url'] for t in item.get('media', {}).get('transcodings', []) 
-                                       if t['format']['protocol'] == 'progressive'), None)
-                        if not prog_url: continue
-
-                        candidates.append({
-                            'source': 'SC',
-                            'id': str(item['id']),
-                            'title': item.get('title', '')[:100],
-                            'artist': item.get('user', {}).get('username', 'Unknown')[:50],
-                            'playback_count': item.get('playback_count', 0),
-                            'duration': item.get('duration', 0),
-                            'artwork_url': artwork,
-                            'media_url_template': prog_url 
-                        })
-                    return candidates
-            except Exception as e: 
-                logger.error(f"☁️ SC Search Exception: {e}")
-                return []
-
-    async def resolve_url_by_id(self, track_id):
-        client_id = self.key_manager.get_id()
         try:
-            logger.info(f"☁️ SC: Получаю ссылку на трек {track_id}")
-            info_url = f"https://api-v2.soundcloud.com/tracks/{track_id}"
-            
-            async with self.session.get(info_url, params={"client_id": client_id}, timeout=4) as resp:
-                if resp.status != 200: 
-                    logger.error(f"☁️ SC: Ошибка получения инфо трека {resp.status}")
-                    return None
-                
-                data = await resp.json(loads=ujson.loads)
+            async with self.limiter.slot() as slot:
+                # logger.info(f"☁️ SC: Search '{query}'")
+                status, data = await self._get_json(f"{SC_API}/search/tracks", params)
+                if data is None: 
+                    logger.error(f"☁️ SC: Ошибка API {status}")
+                    slot.fail()
+                    return []
                 
-                prog_url = next((t['url'] for t in data.get('media', {}).get('transcodings', []) 
-                               if t['format']['protocol'] == 'progressive'), None)
+                collection = data.get('collection', [])
                 
-                if not prog_url: 
-                    logger.warning(f"☁️ SC: Нет progressive ссылки для {track_id}")
-                    return None
+                # logger.info(f"☁️ SC: Найдено {len(collection)} сырых треков")
                 
-                final_url = await self.resolve_url(prog_url)
-                if not final_url: 
-                    logger.warning(f"☁️ SC: Не удалось разрешить final url")
-                    return None
+                candidates = []
+                for item in collection:
+                    if not item.get('streamable'): continue
+                    artwork = item.get('artwork_url') or item.get('user', {}).get('avatar_url')
+                    if artwork: artwork = artwork.replace('large', 't500x500')
+                    
+                    prog_url = next((t['url'] for t in item.get('media', {}).get('transcodings', []) 
+                                   if t['format']['protocol'] == 'progressive'), None)
+                    if not prog_url: continue
 
-                artwork = data.get('artwork_url') or data.get('user', {}).get('avatar_url')
-                if artwork: artwork = artwork.replace('large', 't500x500')
+                    candidate = Candidate(
+                        'SC', str(item['id']),
+                        item.get('title', '')[:100],
+                        item.get('user', {}).get('username', 'Unknown')[:50],
+                        item.get('playback_count', 0),
+                        item.get('duration', 0),
+                        artwork,
+                        prog_url
+                    )
+                    candidates.append(candidate)
+                    self.meta[candidate.id] = candidate
+                return candidates
+        except LimiterFull:
+            logger.warning("☁️ SC: перегружен, поиск пропущен")
+            return []
+        except Exception as e: 
+            logger.error(f"☁️ SC Search Exception: {e}")
+            return []
 
-                logger.info(f"☁️ SC: ✅ Ссылка получена!")
+    async def resolve_url_by_id(self, track_id):
+        meta = self.meta.get(str(track_id))
+        if meta:
+            # Быстрый путь: данные из поиска, один запрос вместо двух
+            try:
+                final_url = await self.resolve_url(meta.media_url_template)
+            except LimiterFull:
+                # Клики ждут слот без лимита очереди, так что сюда не попадаем; но и метаданные не трогаем
+                logger.warning(f"☁️ SC: хост перегружен, трек {track_id} не разрешён")
+                return None
+            if final_url:
+                logger.info(f"☁️ SC: ✅ Ссылка получена (из поиска)")
                 return {
                     'url': final_url,
-                    'title': data.get('title', 'Track'),
-                    'artist': data.get('user', {}).get('username', 'SoundCloud'),
-                    'thumbnail': artwork
+                    'title': meta.title or 'Track',
+                    'artist': meta.artist,
+                    'thumbnail': meta.artwork_url
                 }
+            # Transcoding ссылка протухла - идём длинным путём
+            self.meta.pop(str(track_id), None)
+
+        try:
+            logger.info(f"☁️ SC: Получаю ссылку на трек {track_id}")
+            status, data = await self._get_json(f"{SC_API}/tracks/{track_id}", priority=True)
+            if data is None: 
+                logger.error(f"☁️ SC: Ошибка получения инфо трека {status}")
+                return None
+            
+            prog_url = next((t['url'] for t in data.get('media', {}).get('transcodings', []) 
+                           if t['format']['protocol'] == 'progressive'), None)
+            
+            if not prog_url: 
+                logger.warning(f"☁️ SC: Нет progressive ссылки для {track_id}")
+                return None
+            
+            final_url = await self.resolve_url(prog_url)
+            if not final_url: 
+                logger.warning(f"☁️ SC: Не удалось разрешить final url")
+                return None
+
+            artwork = data.get('artwork_url') or data.get('user', {}).get('avatar_url')
+            if artwork: artwork = artwork.replace('large', 't500x500')
+
+            logger.info(f"☁️ SC: ✅ Ссылка получена!")
+            return {
+                'url': final_url,
+                'title': data.get('title', 'Track'),
+                'artist': data.get('user', {}).get('username', 'SoundCloud'),
+                'thumbnail': artwork
+            }
+        except LimiterFull:
+            logger.warning(f"☁️ SC: хост перегружен, трек {track_id} не разрешён")
+            return None
         except Exception as e:
             logger.error(f"☁️ SC Resolve Error: {e}")
             return None
 
     async def resolve_url(self, url: str):
         try:
-            async with self.session.get(url, params={"client_id": self.key_manager.get_id()}, timeout=4) as resp:
-                if resp.status == 200: return (await resp.json(loads=ujson.loads)).get('url')
-        except: return None
+            _, data = await self._get_json(url, priority=True)
+            return data.get('url') if data else None
+        except LimiterFull: raise # хост занят - это не протухшая ссылка
+        except Exception: return None
 
 class YouTubeEngine:
-    __slots__ = ('session', 'sem')
+    __slots__ = ('session', 'limiter', 'mirrors')
     def __init__(self, session):
         self.session = session
-        self.sem = asyncio.Semaphore(4)
+        self.limiter = AdaptiveLimiter("YT", metric=ENGINE_SECONDS)
+        self.mirrors = MirrorPool(session, PIPED_MIRRORS)
 
     async def search_raw(self, query: str):
-        mirrors = PIPED_MIRRORS.copy()
-        random.shuffle(mirrors)
-        
-        async with self.sem:
-            for base in mirrors:
-                try:
-                    # logger.info(f"▶️ YT Search: Пробую {base}...")
-                    async with self.session.get(f"{base}/search", params={"q": query, "filter": "videos"}, timeout=3) as resp:
-                        if resp.status == 200:
-                            data = await resp.json(loads=ujson.loads)
-                            items = data.get('items', [])
-                            candidates = []
-                            for item in items[:SEARCH_CANDIDATES_YT]:
-                                url_part = item.get('url', '')
-                                if "watch?v=" not in url_part: continue
-                                candidates.append({
-                                    'source': 'YT',
-                                    'id': url_part.split("v=")[-1].split("&")[0],
-                                    'title': item.get('title', '')[:100],
-                                    'artist': item.get('uploaderName', 'YouTube')[:50],
-                                    'playback_count': item.get('views', 0),
-                                    'duration': item.get('duration', 0) * 1000,
-                                    'artwork_url': item.get('thumbnail')
-                                })
-                            if candidates:
-                                # logger.info(f"▶️ YT: ✅ Найдено {len(candidates)} на {base}")
-                                return candidates
-                        else:
-                            pass
-                            # logger.debug(f"▶️ YT Search: {base} returned {resp.status}")
-                except: continue
-            
+        try:
+            async with self.limiter.slot() as slot:
+                candidates = await self.mirrors.fetch(
+                    "/search", self._parse_search,
+                    params={"q": query, "filter": "videos"}, timeout=3
+                )
+                if candidates is None: slot.fail()
+        except LimiterFull:
+            logger.warning("▶️ YT: перегружен, поиск пропущен")
+            return []
+        if candidates is None:
             logger.warning("▶️ YT Search: ❌ Все зеркала молчат!")
             return []
+        return candidates
 
-    async def resolve_url(self, video_id):
-        mirrors = PIPED_MIRRORS.copy()
-        random.shuffle(mirrors)
+    @staticmethod
+    async def _parse_search(base, resp):
+        if resp.status != 200:
+            # logger.debug(f"▶️ YT Search: {base} returned {resp.status}")
+            return None
+        data = await resp.json(loads=ujson.loads)
+        items = data.get('items', [])
+        candidates = []
+        for item in items[:SEARCH_CANDIDATES_YT]:
+            url_part = item.get('url', '')
+            if "watch?v=" not in url_part: continue
+            candidates.append(Candidate(
+                'YT', url_part.split("v=")[-1].split("&")[0],
+                item.get('title', '')[:100],
+                item.get('uploaderName', 'YouTube')[:50],
+                item.get('views', 0),
+                item.get('duration', 0) * 1000,
+                item.get('thumbnail')
+            ))
+        # Пустой ответ считаем сбоем зеркала - пробуем следующее
+        return candidates or None
 
+    async def resolve_url(self, video_id):
         logger.info(f"▶️ YT Resolve: Ищу потоки для {video_id}...")
 
-        for base in mirrors:
-            try:
-                # logger.debug(f"▶️ YT Resolve: Пробую {base}")
-                async with self.session.get(f"{base}/streams/{video_id}", timeout=4) as resp:
-                    if resp.status != 200: 
-                        # logger.debug(f"⚠️ {base} -> Status {resp.status}")
-                        continue
-                    
-                    data = await resp.json(loads=ujson.loads)
-                    
-                    if not data or 'audioStreams' not in data or not data['audioStreams']:
-                        logger.warning(f"⚠️ {base} -> Пустой список audioStreams (Блок)")
-                        continue 
+        try:
+            track = await self.mirrors.fetch(f"/streams/{video_id}", self._parse_streams, timeout=4, priority=True)
+        except LimiterFull:
+            logger.warning(f"▶️ YT: все зеркала перегружены, {video_id} не разрешён")
+            return None
+        if track is None:
+            logger.error(f"❌ YT: Не удалось найти рабочий поток на {len(self.mirrors.mirrors)} зеркалах!")
+        return track
 
-                    streams = data['audioStreams']
-                    best = next((s for s in streams if s.get('format') == 'M4A'), None)
-                    if not best and streams: best = streams[0]
-                    
-                    if not best: continue
-
-                    logger.info(f"✅ YT: УСПЕХ! Поток найден на {base}")
-                    return {
-                        'url': best['url'],
-                        'title': data.get('title', 'Track'),
-                        'artist': data.get('uploader', 'YouTube'),
-                        'thumbnail': data.get('thumbnailUrl')
-                    }
-            except Exception as e: 
-                # logger.debug(f"❌ {base} error: {e}")
-                continue
+    @staticmethod
+    async def _parse_streams(base, resp):
+        if resp.status != 200: 
+            # logger.debug(f"⚠️ {base} -> Status {resp.status}")
+            return None
+        
+        data = await resp.json(loads=ujson.loads)
+        
+        if not data or 'audioStreams' not in data or not data['audioStreams']:
+            logger.warning(f"⚠️ {base} -> Пустой список audioStreams (Блок)")
+            return None
+
+        streams = data['audioStreams']
+        best = next((s for s in streams if s.get('format') == 'M4A'), None)
+        if not best and streams: best = streams[0]
         
-        logger.error(f"❌ YT: Не удалось найти рабочий поток на {len(mirrors)} зеркалах!")
-        return None
+        if not best: return None
+
+        logger.info(f"✅ YT: УСПЕХ! Поток найден на {base}")
+        return {
+            'url': best['url'],
+            'title': data.get('title', 'Track'),
+            'artist': data.get('uploader', 'YouTube'),
+            'thumbnail': data.get('thumbnailUrl')
+        }
 
 class MultiEngine:
     def __init__(self, session, sc_key_manager):
         self.sc = SoundCloudEngine(session, sc_key_manager)
         self.yt = YouTubeEngine(session)
+        # Кэш результатов: (нормализованный запрос, source_mode) -> список кандидатов
+        self.cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=CACHE_TTL)
+        # Поиски в полёте: тот же ключ -> Task, на который ждут повторные запросы
+        self.inflight = {}
+        # Task -> сколько запросов его ждут (для отмены, когда ждать некому)
+        self.waiters = {}
+        # Фоновые дозагрузки опоздавших движков (держим ссылки, чтобы не собрал GC)
+        self.background = set()
+        # Опоздавшие движки дорабатывают: ключ -> Task дозагрузки, тот же запрос не запускает их заново
+        self.late = {}
+        # Частичная выдача на это время (только непустая: пустую лучше дождаться)
+        self.partial = {}
+        self.purge_task = None
+        self.stats = {'hit': 0, 'miss': 0, 'coalesced': 0, 'shared': 0} # исходы поиска в кэшах
+        # События поиска, которые не исход обращения к кэшу
+        self.events = {'partial': 0, 'partial_hit': 0, 'cancelled': 0, 'shared_timeout': 0}
+
+    def cache_stats(self):
+        return {**self.stats, **self.events,
+                'size': len(self.cache), 'inflight': len(self.inflight), 'late': len(self.late)}
 
     async def search(self, query: str, source_mode='all'):
+        """Результаты из кэша общие для всех вызывающих - не мутировать!"""
+        key = (normalize_query(query), source_mode)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.stats['hit'] += 1
+            tracing.tag('search', 'hit')
+            return cached
+
+        partial = self.partial.get(key)
+        if partial is not None:
+            self.events['partial_hit'] += 1
+            tracing.tag('search', 'partial')
+            return partial
+
+        late = self.late.get(key)
+        if late is not None:
+            # Показать пока нечего - ждём опоздавших, как и общий поиск; отмена нас их не трогает
+            self.stats['coalesced'] += 1
+            tracing.tag('search', 'coalesced')
+            return await asyncio.shield(late)
+
+        task = self.inflight.get(key)
+        if task is not None:
+            # HTTP спаны достанутся трассе того, кто запустил поиск
+            self.stats['coalesced'] += 1
+            tracing.tag('search', 'coalesced')
+        else:
+            self.stats['miss'] += 1
+            tracing.tag('search', 'miss')
+            task = asyncio.create_task(self._search_uncached(key, query, source_mode))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._on_search_done(key, t))
+
+        # shield: отмена одного ожидающего не должна убивать общий поиск,
+        # но если ушёл последний - отменяем и его вместе с HTTP запросами
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiters[task] == 1 and not task.done():
+                self.events['cancelled'] += 1
+                task.cancel()
+                # Умирающий поиск не должен достаться новому запросу: тот получил бы чужую отмену
+                if self.inflight.get(key) is task: del self.inflight[key]
+            raise
+        finally:
+            left = self.waiters.pop(task) - 1
+            if left: self.waiters[task] = left
+
+    def _on_search_done(self, key, task):
+        # Ключ мог уже занять новый поиск (старый отменили и убрали раньше)
+        if self.inflight.get(key) is task: del self.inflight[key]
+
+    @staticmethod
+    def _shared_key(key):
+        query, source_mode = key
+        return f"{source_mode}:{query}"
+
+    def _store(self, key, ranked):
+        # Пустой ответ не кэшируем: скорее всего движки временно лежат
+        if not ranked: return
+        self.cache[key] = ranked
+        save_search_cache(self._shared_key(key), ujson.dumps([c.pack() for c in ranked]), SEARCH_L2_TTL)
+
+    async def _load_shared(self, key):
+        """Выдача из общей таблицы (после рестарта или от другого инстанса)"""
+        payload = await get_search_cache(self._shared_key(key))
+        if not payload: return None
+        try:
+            ranked = [Candidate.unpack(row) for row in ujson.loads(payload)]
+        except Exception as e:
+            logger.warning(f"🗄 Битая выдача в search_cache: {e}")
+            return None
+        # Клик по SC кандидату должен идти быстрым путём, как после живого поиска
+        for c in ranked:
+            if c.source == 'SC' and c.media_url_template: self.sc.meta[c.id] = c
+        self.cache[key] = ranked
+        self.stats['shared'] += 1
+        tracing.tag('search', 'shared')
+        return ranked
+
+    def start_purge(self):
+        if self.purge_task is None:
+            self.purge_task = asyncio.create_task(self._purge_loop())
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(SEARCH_L2_PURGE_INTERVAL)
+            try:
+                removed = await purge_search_cache()
+                if removed: logger.info(f"🗄 search_cache: удалено {removed} протухших выдач")
+            except Exception as e:
+                logger.warning(f"🗄 Чистка search_cache не удалась: {e}")
+
+    @staticmethod
+    def _collect(task, ranker, out):
+        if task.cancelled() or task.exception() is not None: return
+        batch = task.result()
+        score = ranker.score
+        for c in batch:
+            c.score = score(c)
+        out.extend(batch)
+
+    @staticmethod
+    def _enough(found):
+        if not SEARCH_ENOUGH: return False
+        good = sum(1 for c in found if c.score >= SEARCH_GOOD_SCORE)
+        return good >= SEARCH_ENOUGH
+
+    async def _search_uncached(self, key, query: str, source_mode):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SEARCH_DEADLINE # чтение общей таблицы - тоже часть поиска
+        try:
+            with tracing.span('search_cache_db'):
+                # Пул общий с кликами и рассылкой: не ждём свободного соединения дольше бюджета
+                shared = await asyncio.wait_for(self._load_shared(key), SEARCH_L2_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.events['shared_timeout'] += 1
+            shared = None
+        if shared is not None:
+            logger.info(f"🗄 SEARCH SHARED: '{query}' - {len(shared)} кандидатов")
+            return shared
+
         logger.info(f"🔍 SEARCH START: '{query}'")
-        tasks = []
-        if source_mode in ['all', 'sc']: tasks.append(asyncio.create_task(self.sc.search_raw(query)))
-        if source_mode in ['all', 'yt']: tasks.append(asyncio.create_task(self.yt.search_raw(query)))
-        
-        if not tasks: return []
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        final = []
-        for r in results:
-            if isinstance(r, list): final.extend(r)
-        
-        # Сортировка
-        for c in final:
-            c['score'] = calculate_score(c, query)
-        final.sort(key=lambda x: x['score'], reverse=True)
-        
-        logger.info(f"🔍 SEARCH END: Найдено {len(final)} кандидатов")
-        return final
\ No newline at end of file
+        engines = []
+        if source_mode in ['all', 'sc']: engines.append(('SC', self.sc.search_raw))
+        if source_mode in ['all', 'yt']: engines.append(('YT', self.yt.search_raw))
+        if not engines: return []
+
+        # У каждого движка свой дедлайн, у поиска в целом - свой (SEARCH_DEADLINE)
+        pending = {
+            asyncio.create_task(asyncio.wait_for(fn(query), ENGINE_DEADLINES[name]), name=name)
+            for name, fn in engines
+        }
+        ranker = QueryRanker(query) # запрос разбираем один раз на весь поиск
+        found = []
+        try:
+            while pending:
+                left = deadline - loop.time()
+                if left <= 0: break
+                done, pending = await asyncio.wait(pending, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+                for t in done: self._collect(t, ranker, found)
+                if pending and self._enough(found): break
+        except asyncio.CancelledError:
+            for t in pending: t.cancel()
+            raise
+
+        ranked = sorted(found, key=by_score, reverse=True)
+        if pending:
+            # Отвечаем тем, что есть; опоздавшие докачиваются в фоне прямо в кэш
+            late = ", ".join(t.get_name() for t in pending)
+            logger.info(f"⏱ SEARCH PARTIAL: {len(ranked)} кандидатов, ждём в фоне: {late}")
+            self.events['partial'] += 1
+            if ranked: self.partial[key] = ranked
+            task = self.late[key] = asyncio.create_task(self._finish_late(key, ranker, found, pending))
+            self.background.add(task)
+            task.add_done_callback(self.background.discard)
+        else:
+            self._store(key, ranked)
+            logger.info(f"🔍 SEARCH END: Найдено {len(ranked)} кандидатов")
+        return ranked
+
+    async def _finish_late(self, key, ranker, found, pending):
+        found = list(found)
+        try:
+            done, _ = await asyncio.wait(pending)
+            for t in done:
+                if not t.cancelled() and isinstance(t.exception(), asyncio.TimeoutError):
+                    logger.warning(f"⏱ {t.get_name()}: дедлайн движка истёк")
+                self._collect(t, ranker, found)
+            found.sort(key=by_score, reverse=True)
+            self._store(key, found)
+            logger.info(f"🔍 SEARCH END (late): Найдено {len(found)} кандидатов")
+            return found
+        finally:
+            # Полная выдача уже в кэше (или движки так ничего и не дали - тогда следующий запрос ищет заново)
+            self.late.pop(key, None)
+            self.partial.pop(key, None)
@@ -1,20 +1,48 @@
 import asyncio
 import re
 import logging # <--- ЛОГИ
-from aiogram import Router, types
+from aiogram import Router, F, types
+from aiogram.filters import Command, CommandStart
 from aiogram.types import (
-    InlineQuery, InlineQueryResultArticle, InputTextMessageContent,
+    InlineQuery, InlineQueryResultArticle, InlineQueryResultCachedAudio, InputTextMessageContent,
     InputMediaAudio, ChosenInlineResult, InlineKeyboardMarkup, InlineKeyboardButton,
     URLInputFile
 )
 from aiogram.exceptions import TelegramBadRequest
-from config import INLINE_LIMIT, CACHE_CHANNEL_ID, BYPASS_CHANNEL_ID, BYPASS_CHANNEL_USERNAME
-from database import get_cached_info, save_cached_info
-from utils import format_plays
+from config import (
+    ADMIN_ID, INLINE_LIMIT, INLINE_DEBOUNCE, CACHE_CHANNEL_ID, BYPASS_CHANNEL_ID, BYPASS_CHANNEL_USERNAME,
+    UPLOAD_LEASE_TTL, UPLOAD_LEASE_POLL, TRANSFER_WORKERS, TRANSFER_QUEUE,
+    PREFETCH_MODE, PREFETCH_TOP_K, PREFETCH_MIN_POPULARITY, PREFETCH_PER_MINUTE,
+    PREFETCH_MAX_INFLIGHT, PREFETCH_WINDOW,
+    BROADCAST_RATE, BROADCAST_PAGE, BROADCAST_CONCURRENCY
+)
+from database import (
+    get_cached_info, save_cached_info, wait_cache_written, acquire_upload_lease, renew_upload_lease, release_upload_lease,
+    add_user, get_users_count
+)
+from broadcast import Broadcaster
+from debounce import QueryDebouncer
+from metrics import CLICK_STAGE_SECONDS
+import tracing
+from library import TrackIndex
+from prefetch import Prefetcher
+from transfers import TransferScheduler, TransferBusy, PRIORITY_CHOSEN, PRIORITY_RETRY, PRIORITY_PREFETCH
 
 router = Router()
 engine = None
 bot_instance = None 
+bot_caption = None # "@username" бота, запрашиваем один раз
+debouncer = QueryDebouncer(INLINE_DEBOUNCE)
+library = TrackIndex()
+transfers = TransferScheduler(TRANSFER_WORKERS, TRANSFER_QUEUE)
+uploads = {} # (source, item_id) -> Task fetch_or_upload: одна на трек, её ждут все клики и префетч
+upload_priority = {} # (source, item_id) -> лучший приоритет среди ждущих
+lease_releases = set() # снятие аренд после записи file_cache (держим ссылки на задачи)
+prefetcher = Prefetcher(
+    PREFETCH_MODE, PREFETCH_TOP_K, PREFETCH_MIN_POPULARITY,
+    PREFETCH_PER_MINUTE, PREFETCH_MAX_INFLIGHT, PREFETCH_WINDOW
+)
+broadcaster = Broadcaster(BROADCAST_RATE, BROADCAST_PAGE, BROADCAST_CONCURRENCY)
 
 # Настраиваем логгер
 logger = logging.getLogger("HANDLERS")
@@ -23,111 +51,241 @@ def setup_handlers(main_engine, main_bot):
     global engine, bot_instance
     engine = main_engine
     bot_instance = main_bot
+    broadcaster.bot = main_bot
+    transfers.start()
+    prefetcher.bind(get_cached_info, resolve_track, prefetch_upload, transfers_have_room)
+
+async def get_caption():
+    global bot_caption
+    if bot_caption is None: bot_caption = f"@{(await bot_instance.me()).username}"
+    return bot_caption
 
 def clean_filename(text):
     s = re.sub(r'[\\/*?:"<>|]', '', text)
     return s.strip()[:60] + ".mp3"
 
 # --- 1. СПИСОК ---
+def cached_result(track, caption):
+    return InlineQueryResultCachedAudio(
+        id=f"c:{track.source}:{track.id}",
+        audio_file_id=track.file_id,
+        caption=caption
+    )
+
+def article_result(item):
+    return InlineQueryResultArticle(
+        id=f"dl:{item.source}:{item.id}",
+        title=item.clean_title,
+        description=f"{item.artist}\n{item.duration_text} • {item.plays_text}",
+        thumbnail_url=item.artwork_url, 
+        input_message_content=InputTextMessageContent(
+            message_text="⌛", 
+        ),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=".", callback_data=f"f:{item.source}:{item.id}")
+        ]])
+    )
+
 @router.inline_query()
 async def inline_handler(query: InlineQuery):
     text = query.query.strip()
     if len(text) < 2: return
     # Лог только при старте поиска, чтобы не спамить
     # logger.info(f"IQ: {text}") 
+    with tracing.trace('inline', query.from_user.id, query=text):
+        await answer_inline(query, text)
+
+async def answer_inline(query: InlineQuery, text):
+    # Сначала уже залитые треки: отдаются сразу готовым аудио, без движков и без клика
+    local = library.search(text, INLINE_LIMIT)
+    results = []
+    if len(local) < INLINE_LIMIT:
+        # Ждём паузу в наборе; старый запрос этого юзера отменяется вместе с его поиском
+        with tracing.span('search'):
+            results = await debouncer.run(query.from_user.id, lambda: engine.search(text, 'all'))
+        if results is None: # вытеснен более новым запросом
+            tracing.tag('superseded', True)
+            return
+    tracing.tag('results', len(local) + len(results))
+    if not local and not results: return
 
-    results = await engine.search(text, 'all')
-    if not results: return
-
-    iq_results = []
-    for item in results[:INLINE_LIMIT]:
-        result_id = f"dl:{item['source']}:{item['id']}"
-        
-        clean_title = item['title'].replace(item['artist'], '').strip(' -|:').replace('.mp3', '')
-        if not clean_title: clean_title = item['title']
-        
-        m, s = divmod(item['duration'] // 1000, 60)
-        thumb = item.get('artwork_url')
-
-        iq_results.append(InlineQueryResultArticle(
-            id=result_id,
-            title=clean_title,
-            description=f"{item['artist']}\n{m:02d}:{s:02d} • {format_plays(item['playback_count'])}",
-            thumbnail_url=thumb, 
-            input_message_content=InputTextMessageContent(
-                message_text="⌛", 
-            ),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text=".", callback_data=f"f:{item['source']}:{item['id']}")
-            ]])
-        ))
+    caption = await get_caption()
+    iq_results = [cached_result(t, caption) for t in local]
+    seen = {t.key for t in local}
+    for item in results:
+        if len(iq_results) >= INLINE_LIMIT: break
+        key = item.key
+        if key in seen: continue
+        seen.add(key)
+        track = library.tracks.get(key)
+        iq_results.append(cached_result(track, caption) if track else article_result(item))
 
     await query.answer(iq_results, cache_time=300, is_personal=True)
+    # Юзер уже видит выдачу - в фоне готовим верхние треки к клику
+    if results: prefetcher.schedule(text, results)
 
 
 # --- 2. ГЛАВНАЯ ЛОГИКА ---
-async def process_track(im_id, source, item_id):
+
+async def resolve_track(source, item_id):
+    if source == 'SC': return await engine.sc.resolve_url_by_id(item_id)
+    return await engine.yt.resolve_url(item_id)
+
+async def upload_track(source, item_id):
+    """resolve + send_audio в кэш-канал. (file_id, message_id, байты) или None, если ссылку не достали"""
+    # Ссылка могла быть уже получена префетчем
+    track = prefetcher.take_resolved(source, item_id)
+    if not track:
+        with CLICK_STAGE_SECONDS.time('resolve'):
+            track = await resolve_track(source, item_id)
+    
+    if not track or not track.get('url'):
+        logger.error("❌ FAILED to resolve URL")
+        return None
+
+    title = track['title'][:100]
+    performer = track['artist'][:64]
+    thumb_url = track.get('thumbnail')
+    safe_name = clean_filename(f"{performer} - {title}")
+
+    logger.info(f"📤 UPLOADING to CACHE CHANNEL ({CACHE_CHANNEL_ID})")
+    
+    with CLICK_STAGE_SECONDS.time('upload'):
+        dump_msg = await bot_instance.send_audio(
+            chat_id=CACHE_CHANNEL_ID,
+            audio=URLInputFile(track['url'], filename=safe_name),
+            thumbnail=URLInputFile(thumb_url) if thumb_url else None,
+            title=title,
+            performer=performer,
+            caption=f"#{source}|{item_id}"
+        )
+    
+    file_id = dump_msg.audio.file_id
+    cache_msg_id = dump_msg.message_id
+    size = dump_msg.audio.file_size or 0
+    duration = dump_msg.audio.duration
+    transfers.add_bytes(size)
+    
+    await save_cached_info(source, item_id, file_id, cache_msg_id, title, performer, duration)
+    library.add(source, item_id, file_id, title, performer, duration)
+    logger.info("✅ UPLOAD SUCCESS")
+    return file_id, cache_msg_id, size
+
+def upload_once(source, item_id, priority):
+    """Task с результатом fetch_or_upload; TransferBusy - если очередь загрузок полна"""
+    key = (source, item_id)
+    upload_priority[key] = min(priority, upload_priority.get(key, priority))
+    task = uploads.get(key)
+    if task is not None:
+        transfers.bump(key, priority)
+        return task
+    task = uploads[key] = asyncio.create_task(fetch_or_upload(source, item_id))
+    task.add_done_callback(lambda t: upload_done(key, t))
+    return task
+
+def upload_done(key, task):
+    uploads.pop(key, None)
+    upload_priority.pop(key, None)
+    # Ждущие могли разойтись (отмена клика) - забираем исключение, чтобы asyncio не ругался
+    if not task.cancelled(): task.exception()
+
+async def fetch_or_upload(source, item_id):
+    """Одна загрузка на трек и между процессами: кто взял аренду - качает, остальные ждут file_id.
+    Чужую заливку ждём здесь, вне пула загрузок: его воркеры заняты только своими треками"""
+    while not await acquire_upload_lease(source, item_id):
+        logger.info(f"⏳ {source} {item_id}: уже грузится другим процессом, жду...")
+        await asyncio.sleep(UPLOAD_LEASE_POLL)
+        cached = await get_cached_info(source, item_id, fresh=True)
+        if cached: return cached['file_id'], cached['message_id'], 0
+    keeper = asyncio.create_task(keep_upload_lease(source, item_id))
+    try:
+        # Пока брали аренду, предыдущий владелец мог успеть всё залить
+        cached = await get_cached_info(source, item_id, fresh=True)
+        if cached: return cached['file_id'], cached['message_id'], 0
+        key = (source, item_id)
+        return await transfers.submit(
+            key, tracing.bind('transfer_queue', lambda: upload_track(source, item_id)), upload_priority[key]
+        )
+    finally:
+        keeper.cancel()
+        # Юзер получает трек сразу, а аренду снимаем в фоне после записи строки в базу:
+        # иначе другой процесс не найдёт file_id и зальёт трек второй раз
+        task = asyncio.create_task(release_when_written(source, item_id))
+        lease_releases.add(task)
+        task.add_done_callback(lease_releases.discard)
+
+async def release_when_written(source, item_id):
+    await wait_cache_written(source, item_id)
+    await release_upload_lease(source, item_id)
+
+async def keep_upload_lease(source, item_id):
+    """Продлеваем аренду, пока стоим в очереди и льём: долгая заливка не должна достаться второму процессу"""
+    while True:
+        await asyncio.sleep(UPLOAD_LEASE_TTL / 3)
+        if not await renew_upload_lease(source, item_id):
+            logger.warning(f"⏳ {source} {item_id}: аренду перехватили, возможен дубль заливки")
+            return
+
+async def prefetch_upload(source, item_id):
+    """Заливка для префетча: та же очередь, но с низшим приоритетом. Байты или None"""
+    uploaded = await asyncio.shield(upload_once(source, item_id, PRIORITY_PREFETCH))
+    return uploaded[2] if uploaded else None
+
+def transfers_have_room():
+    # Префетч не должен отнимать места в очереди у живых кликов
+    return transfers.queued < transfers.max_queue // 2
+
+async def process_track(im_id, source, item_id, priority=PRIORITY_CHOSEN):
     logger.info(f"👉 CLICK: {source} {item_id}")
+    prefetcher.on_click(source, item_id)
     
     # А. ПРОВЕРКА КЭША
-    cached = await get_cached_info(source, item_id)
+    with CLICK_STAGE_SECONDS.time('cache'):
+        cached = await get_cached_info(source, item_id)
     file_id = cached.get('file_id') if cached else None
     cache_msg_id = cached.get('message_id') if cached else None
 
     if file_id:
         logger.info(f"💾 CACHE HIT: {file_id[:10]}...")
     else:
+        # Очередь загрузок: одна задача на трек, все клики по нему ждут её результат
         logger.info("🌍 DOWNLOADING (No cache)...")
         try:
-            track = None
-            if source == 'SC': track = await engine.sc.resolve_url_by_id(item_id)
-            else: track = await engine.yt.resolve_url(item_id)
-            
-            if not track or not track.get('url'):
-                logger.error("❌ FAILED to resolve URL")
-                try: await bot_instance.edit_message_text(inline_message_id=im_id, text="❌")
-                except: pass
-                return
-
-            title = track['title'][:100]
-            performer = track['artist'][:64]
-            thumb_url = track.get('thumbnail')
-            safe_name = clean_filename(f"{performer} - {title}")
-
-            logger.info(f"📤 UPLOADING to CACHE CHANNEL ({CACHE_CHANNEL_ID})")
-            
-            dump_msg = await bot_instance.send_audio(
-                chat_id=CACHE_CHANNEL_ID,
-                audio=URLInputFile(track['url'], filename=safe_name),
-                thumbnail=URLInputFile(thumb_url) if thumb_url else None,
-                title=title,
-                performer=performer,
-                caption=f"#{source}|{item_id}"
-            )
-            
-            file_id = dump_msg.audio.file_id
-            cache_msg_id = dump_msg.message_id
-            
-            asyncio.create_task(save_cached_info(source, item_id, file_id, cache_msg_id))
-            logger.info("✅ UPLOAD SUCCESS")
-
+            # shield: отмена одного клика не отменяет загрузку для остальных
+            uploaded = await asyncio.shield(upload_once(source, item_id, priority))
+        except TransferBusy:
+            logger.warning(f"🚦 BUSY: очередь загрузок полна ({transfers.queued})")
+            try:
+                await bot_instance.edit_message_text(
+                    inline_message_id=im_id, text="⏳ Слишком много загрузок, нажми ещё раз чуть позже",
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                        InlineKeyboardButton(text="🔄", callback_data=f"f:{source}:{item_id}")
+                    ]])
+                )
+            except: pass
+            return
         except Exception as e:
             logger.error(f"❌ UPLOAD ERROR: {e}")
             try: await bot_instance.edit_message_text(inline_message_id=im_id, text="❌ Err")
             except: pass
             return
 
+        if not uploaded:
+            try: await bot_instance.edit_message_text(inline_message_id=im_id, text="❌")
+            except: pass
+            return
+        file_id, cache_msg_id, _ = uploaded
+
     # В. ПОКАЗ ЮЗЕРУ
     if file_id:
         try:
-            await bot_instance.edit_message_media(
-                inline_message_id=im_id,
-                media=InputMediaAudio(
-                    media=file_id, 
-                    caption=f"@{ (await bot_instance.get_me()).username }"
-                ),
-                reply_markup=None
-            )
+            caption = await get_caption()
+            with CLICK_STAGE_SECONDS.time('edit'):
+                await bot_instance.edit_message_media(
+                    inline_message_id=im_id,
+                    media=InputMediaAudio(media=file_id, caption=caption),
+                    reply_markup=None
+                )
         except TelegramBadRequest as e:
             if "forbidden" in str(e).lower() or "rights" in str(e).lower():
                 logger.warning(f"🚫 RESTRICTED CHAT: Copying to Bypass...")
@@ -160,11 +318,59 @@ async def process_track(im_id, source, item_id):
              logger.error(f"⚠️ UNKNOWN EDIT ERROR: {e}")
 
 # --- ТРИГГЕРЫ ---
+@router.message(CommandStart())
+async def start_handler(message: types.Message):
+    # Писать первым бот может только тем, кто его запустил - их и запоминаем для рассылок
+    await add_user(message.from_user.id)
+    await message.answer(f"🎧 Набери {await get_caption()} и название трека в любом чате")
+
+@router.message(Command("broadcast"), F.from_user.id == ADMIN_ID)
+async def broadcast_handler(message: types.Message):
+    """Ответом на сообщение - разослать его; без ответа - статус"""
+    target = message.reply_to_message
+    if target:
+        started = await broadcaster.start(message.chat.id, target.message_id, message.from_user.id)
+        text = f"📣 Рассылка запущена, активных: {await get_users_count()}" if started else "📣 Рассылка уже идёт"
+    else:
+        state = await broadcaster.load()
+        text = f"📣 {state['status']}\n{broadcaster.summary(state)}" if state else "📣 Рассылок не было"
+    await message.answer(text)
+
+@router.message(Command("broadcast_stop"), F.from_user.id == ADMIN_ID)
+async def broadcast_stop_handler(message: types.Message):
+    stopped = await broadcaster.stop()
+    await message.answer("⏹ Останавливаю" if stopped else "📣 Рассылка не идёт")
+
+@router.message(Command("broadcast_resume"), F.from_user.id == ADMIN_ID)
+async def broadcast_resume_handler(message: types.Message):
+    resumed = await broadcaster.resume(force=True)
+    await message.answer("▶️ Продолжаю" if resumed else "📣 Нечего продолжать")
+
+@router.message(Command("traces"), F.from_user.id == ADMIN_ID)
+async def traces_handler(message: types.Message):
+    """/traces [n] [inline|click|retry] - самые медленные трассы за окно TRACE_WINDOW"""
+    args = (message.text or "").split()[1:]
+    n = next((int(a) for a in args if a.isdigit()), 3)
+    kind = next((a for a in args if not a.isdigit()), None)
+    found = tracing.slowest(min(n, 10), kind)
+    if not found:
+        await message.answer("🧵 Трасс за окно нет")
+        return
+    text = "\n\n".join(tracing.format_trace(t) for t in found)
+    # В трассах сырые запросы юзеров ("<3" и т.п.) - HTML-разметка бота их не переварит
+    await message.answer(text[:4000], parse_mode=None)
+
 @router.chosen_inline_result()
 async def chosen_handler(chosen: ChosenInlineResult):
     if chosen.result_id.startswith("dl:"):
         p = chosen.result_id.split(":")
-        await process_track(chosen.inline_message_id, p[1], p[2])
+        user_id = chosen.from_user.id
+        with tracing.trace('click', user_id, tracing.last_of(user_id, 'inline'), track=f"{p[1]}:{p[2]}"):
+            await process_track(chosen.inline_message_id, p[1], p[2])
+    elif chosen.result_id.startswith("c:"):
+        # Трек из кэша Telegram отправил сам, process_track не нужен - но это может быть попадание префетча
+        _, source, item_id = chosen.result_id.split(":", 2)
+        prefetcher.on_click(source, item_id)
 
 @router.callback_query(lambda c: c.data.startswith("f:"))
 async def force_dl(call: types.CallbackQuery):
@@ -173,4 +379,6 @@ async def force_dl(call: types.CallbackQuery):
     
     _, src, iid = call.data.split(":")
     if call.inline_message_id:
-        await process_track(call.inline_message_id, src, iid)
\ No newline at end of file
+        user_id = call.from_user.id
+        with tracing.trace('retry', user_id, tracing.last_of(user_id, 'inline'), track=f"{src}:{iid}"):
+            await process_track(call.inline_message_id, src, iid, PRIORITY_RETRY)
\ No newline at end of file
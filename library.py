@@ -0,0 +1,76 @@
+import bisect
+import heapq
+import logging
+import re
+from candidate import Candidate
+from ranking import QueryRanker
+from utils import clean_query
+
+logger = logging.getLogger("LIBRARY")
+
+TOKEN_RE = re.compile(r'\w+')
+MAX_SCORED = 2000 # запрос совпал с большим числом треков - слишком общий, пусть решают движки
+
+class TrackIndex:
+    """In-memory индекс уже залитых треков (file_cache): токен -> треки.
+    Последнее слово запроса матчится по префиксу - юзер его ещё допечатывает."""
+
+    def __init__(self):
+        self.tracks = {} # (source, id) -> Candidate с file_id
+        self.postings = {} # токен -> set((source, id))
+        self.tokens = [] # отсортированные токены для поиска по префиксу
+
+    def __len__(self): return len(self.tracks)
+
+    def add(self, source, item_id, file_id, title, artist, duration=0):
+        if not title: return
+        key = (source, item_id)
+        if key in self.tracks:
+            self.tracks[key].file_id = file_id
+            return
+        self.tracks[key] = Candidate(
+            source, item_id, title, artist or '',
+            duration=(duration or 0) * 1000, file_id=file_id
+        )
+        for token in set(TOKEN_RE.findall(f"{artist} {title}".lower())):
+            keys = self.postings.get(token)
+            if keys is None:
+                keys = self.postings[token] = set()
+                bisect.insort(self.tokens, token)
+            keys.add(key)
+
+    async def load(self, rows):
+        """rows - async итератор строк file_cache (uniq_id, file_id, title, artist, duration)"""
+        try:
+            async for row in rows:
+                source, _, item_id = row['uniq_id'].partition('_')
+                self.add(source, item_id, row['file_id'], row['title'], row['artist'], row['duration'])
+        except Exception as e:
+            logger.error(f"📚 Ошибка загрузки библиотеки: {e}")
+        logger.info(f"📚 Локальная библиотека: {len(self.tracks)} треков")
+
+    def _prefixed(self, prefix):
+        found = set()
+        i = bisect.bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            found |= self.postings[self.tokens[i]]
+            i += 1
+        return found
+
+    def search(self, query, limit):
+        words = TOKEN_RE.findall(clean_query(query))
+        if not words or not self.tracks: return []
+
+        # Редкие полные слова первыми - пересечение быстро сужается
+        *full, last = words
+        sets = sorted((self.postings.get(w, set()) for w in full), key=len)
+        if sets and not sets[0]: return []
+        matched = set(sets[0]) if sets else None
+        for keys in sets[1:]:
+            matched &= keys
+            if not matched: return []
+        tail = self._prefixed(last) if len(last) >= 2 else self.postings.get(last, set())
+        matched = tail if matched is None else matched & tail
+        if not matched or len(matched) > MAX_SCORED: return []
+
+        return heapq.nlargest(limit, (self.tracks[k] for k in matched), key=QueryRanker(query).score)
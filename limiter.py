@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from urllib.parse import urlsplit
+from config import (
+    LIMIT_INITIAL, LIMIT_MIN, LIMIT_MAX, LIMIT_QUEUE, LIMIT_LATENCY_TOLERANCE, LIMIT_BACKOFF
+)
+
+import tracing
+from metrics import UPSTREAM_SECONDS
+
+logger = logging.getLogger("LIMITER")
+
+class LimiterFull(Exception):
+    """Очередь ожидания переполнена - лучше сразу отказать, чем держать инлайн-запрос"""
+
+class Slot:
+    __slots__ = ('limiter', 'priority', 'start', 'queued', 'ok')
+
+    def __init__(self, limiter, priority=False):
+        self.limiter = limiter
+        self.priority = priority
+        self.ok = True
+
+    def fail(self):
+        """Ответ пришёл, но плохой (429/5xx) - для лимита это перегрузка, как и исключение"""
+        self.ok = False
+
+    async def __aenter__(self):
+        self.queued = time.perf_counter()
+        await self.limiter.acquire(self.priority)
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        # Спан с ожиданием слота: в трассе видно, стояли мы в очереди лимитера или ждали апстрим
+        ok = self.ok and exc_type is None
+        tracing.add(self.limiter.name, self.queued, end, wait=tracing.ms(self.start - self.queued), ok=ok)
+        if exc_type is asyncio.CancelledError or exc_type is LimiterFull:
+            # Отмена или отказ вложенного лимитера (хоста) ничего не говорят о здоровье апстрима
+            self.limiter.release()
+        else:
+            self.limiter.release(end - self.start, ok)
+
+class AdaptiveLimiter:
+    """AIMD лимит параллельных запросов: +1 за окно успешных ответов, пока латентность
+    близка к базовой; x LIMIT_BACKOFF при ошибке или росте латентности. Очередь ограничена."""
+
+    def __init__(self, name, initial=LIMIT_INITIAL, min_limit=LIMIT_MIN, max_limit=LIMIT_MAX, max_queue=LIMIT_QUEUE,
+                 metric=None):
+        self.name = name
+        self.metric = metric # гистограмма латентности с меткой name (уже меряем - заодно и для /metrics)
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.inflight = 0
+        self.waiters = deque() # поиски: очередь ограничена max_queue
+        self.urgent = deque() # клики: без лимита, будятся первыми
+        self.base_rtt = None # медленно дрейфующий минимум: латентность без очереди у апстрима
+        self.rtt = None # короткая EWMA: одиночный медленный ответ - ещё не перегрузка
+        self.cut_at = 0.0
+        self.stats = {'ok': 0, 'errors': 0, 'rejected': 0, 'cuts': 0}
+
+    def slot(self, priority=False):
+        return Slot(self, priority)
+
+    async def acquire(self, priority=False):
+        """priority - клик: юзер уже выбрал трек, отказывать нельзя. Ждёт без лимита очереди
+        и встаёт перед поисками; поиски при переполнении сразу получают LimiterFull"""
+        if not self.urgent and not self.waiters and self.inflight < int(self.limit):
+            self.inflight += 1
+            return
+        if not priority and len(self.waiters) >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise LimiterFull(self.name)
+        future = asyncio.get_running_loop().create_future()
+        queue = self.urgent if priority else self.waiters
+        queue.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # слот уже выдали, а мы ушли - возвращаем
+            else:
+                # _wake мог уже снять отменённый future с очереди
+                try: queue.remove(future)
+                except ValueError: pass
+            raise
+
+    def release(self, latency=None, ok=True):
+        saturated = self.inflight >= int(self.limit)
+        self.inflight -= 1
+        if latency is not None:
+            if self.metric: self.metric.observe(latency, self.name)
+            self._adapt(latency, ok, saturated)
+        self._wake()
+
+    def _adapt(self, latency, ok, saturated):
+        now = asyncio.get_running_loop().time()
+        if ok:
+            self.stats['ok'] += 1
+            if self.base_rtt is None or latency < self.base_rtt: self.base_rtt = latency
+            else: self.base_rtt += (latency - self.base_rtt) * 0.01 # апстрим мог честно замедлиться
+            self.rtt = latency if self.rtt is None else self.rtt + (latency - self.rtt) * 0.3
+        else:
+            self.stats['errors'] += 1
+
+        congested = not ok or self.rtt > self.base_rtt * LIMIT_LATENCY_TOLERANCE
+        if congested:
+            # Одно снижение на "волну": ответы, отправленные до снижения, его не повторяют
+            if now - self.cut_at < (self.base_rtt or latency): return
+            self.cut_at = now
+            old = int(self.limit)
+            self.limit = max(self.limit * LIMIT_BACKOFF, self.min_limit)
+            self.stats['cuts'] += 1
+            if int(self.limit) < old:
+                logger.info(f"🚦 {self.name}: лимит {old} -> {int(self.limit)} ({'ошибка' if not ok else f'{self.rtt:.2f}с'})")
+        elif saturated:
+            # Растём, только если упирались в лимит: простой ничего не говорит о запасе
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def _wake(self):
+        while (self.urgent or self.waiters) and self.inflight < int(self.limit):
+            future = (self.urgent or self.waiters).popleft()
+            if future.done(): continue
+            self.inflight += 1
+            future.set_result(None)
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            'limit': round(self.limit, 2), 'inflight': self.inflight, 'queued': len(self.waiters) + len(self.urgent),
+            'base_rtt': round(self.base_rtt, 3) if self.base_rtt else None,
+            'rtt': round(self.rtt, 3) if self.rtt else None,
+        }
+
+class HostLimits:
+    """Лимитер на каждый апстрим-хост, создаётся при первом запросе"""
+
+    def __init__(self):
+        self.limiters = {}
+
+    def for_url(self, url):
+        host = urlsplit(url).netloc
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = AdaptiveLimiter(host, metric=UPSTREAM_SECONDS)
+        return limiter
+
+    def snapshot(self):
+        return {host: limiter.snapshot() for host, limiter in self.limiters.items()}
+
+hosts = HostLimits()
@@ -1,17 +1,34 @@
+import time
+STARTED = time.perf_counter() # до остальных импортов: они тоже часть холодного старта
 import asyncio
 import aiohttp
+import importlib
 import ujson
 import ssl
+import os
 import sys
 import gc
+import signal
+import secrets
 import logging # <--- ВАЖНО
 from aiohttp import web, AsyncResolver
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from config import TG_TOKEN
-from database import init_db, pool
+from config import (
+    TG_TOKEN, FILE_CACHE_WARM, CACHE_CHANNEL_ID, UPDATES_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONCURRENT, WEBHOOK_MAX_PENDING, WEBHOOK_DRAIN_TIMEOUT, WORKERS, METRICS_PORT,
+    BOTAPI_RATE, BOTAPI_CHAT_INTERVAL, BOTAPI_MAX_RETRIES, BOTAPI_MAX_RETRY_AFTER
+)
+import database
+import metrics
+import profiling
+import tracing
+from cluster import Cluster, run_supervisor
+from database import init_db, iter_cached_tracks, warm_file_cache
 from engines import KeyManager, MultiEngine
-from handlers import router, setup_handlers
+from limiter import hosts
+
+# aiogram (pydantic-модели всех типов Bot API) импортируется секунды - дольше, чем поднимается база.
+# Эти модули грузим в потоке, пока цикл ждёт Postgres; супервизору они не нужны вовсе.
+BOT_MODULES = ("botapi", "handlers", "webhook")
 
 # --- НАСТРОЙКА ЛОГОВ ---
 logging.basicConfig(
@@ -24,28 +41,104 @@ logger = logging.getLogger("MAIN")
 async def health_check(request):
     return web.Response(text="Alive")
 
-async def start_web_server():
+async def start_web_server(ingress=None):
     app = web.Application()
-    app.add_routes([web.get('/', health_check)])
+    app.add_routes([web.get('/', health_check), web.get('/metrics', metrics.metrics_handler)])
+    app.add_routes(profiling.routes)
+    if ingress:
+        app.add_routes([web.post(WEBHOOK_PATH, ingress.handle)])
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
-    await web.TCPSite(runner, '0.0.0.0', port).start()
+    # Несколько воркеров слушают один порт, ядро раздаёт соединения между ними
+    await web.TCPSite(runner, '0.0.0.0', port, reuse_port=WORKERS > 1).start()
     logger.info(f"🌍 Web server running on port {port}")
+    return runner
 
-async def main():
-    gc.collect()
-    logger.info("🚀 Initializing Bot...")
-    
-    await init_db()
-    await start_web_server()
+async def start_metrics_server(worker):
+    """Свой порт у каждого воркера: Prometheus скрейпит их по отдельности, а не случайный через общий"""
+    app = web.Application()
+    app.add_routes([web.get('/metrics', metrics.metrics_handler)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', METRICS_PORT + worker).start()
+    logger.info(f"📈 /metrics воркера {worker} на порту {METRICS_PORT + worker}")
+    return runner
 
-    bot = Bot(
-        token=TG_TOKEN, 
-        default=DefaultBotProperties(parse_mode="HTML")
-    )
-    dp = Dispatcher()
+def register_metrics(engine, api, ingress):
+    """Gauge и счётчики, которые подсистемы уже ведут сами - читаются только при скрейпе"""
+    from handlers import library, transfers, prefetcher
+    by_key = lambda stats: {(k,): v for k, v in stats.items()}
+    limiters = lambda: [engine.sc.limiter, engine.yt.limiter, *hosts.limiters.values()]
+    writes = (database.cache_writes, database.user_writes, database.hit_writes,
+              database.search_writes, database.inactive_writes)
+
+    metrics.counter_from("bot_search_cache_total", "Search cache lookups", lambda: by_key(engine.stats), ("result",))
+    metrics.counter_from("bot_search_events_total", "Partial answers, partial hits, cancellations, L2 timeouts",
+                         lambda: by_key(engine.events), ("event",))
+    metrics.counter_from("bot_file_cache_total", "file_id lookups by tier", lambda: by_key(database.file_cache_stats), ("result",))
+    metrics.gauge("bot_searches_inflight", "Upstream searches in flight", lambda: len(engine.inflight))
+    metrics.gauge("bot_transfers", "Transfer queue", lambda: {('queued',): transfers.queued, ('running',): transfers.running}, ("state",))
+    metrics.counter_from("bot_transfers_total", "Finished transfers", lambda: {
+        ('done',): transfers.stats['done'], ('failed',): transfers.stats['failed']
+    }, ("result",))
+    metrics.counter_from("bot_transfer_bytes_total", "Bytes uploaded to the cache channel", lambda: transfers.stats['bytes'])
+    metrics.counter_from("bot_prefetch_total", "Prefetch outcomes",
+                         lambda: {(k,): v for k, v in prefetcher.counters().items() if not k.endswith('bytes')}, ("result",))
+    metrics.counter_from("bot_prefetch_bytes_total", "Bytes uploaded by prefetch", lambda: {
+        ('uploaded',): prefetcher.counters()['bytes'], ('wasted',): prefetcher.counters()['wasted_bytes']
+    }, ("kind",))
+    metrics.gauge("bot_db_pool_connections", "asyncpg pool", lambda: {
+        ('size',): database.pool.get_size(), ('idle',): database.pool.get_idle_size(),
+        ('max',): database.pool.get_max_size(),
+    }, ("state",))
+    metrics.gauge("bot_write_pending", "Rows waiting in write-behind buffers",
+                  lambda: {(w.name,): len(w.pending) + len(w.flushing) for w in writes}, ("buffer",))
+    metrics.counter_from("bot_write_errors_total", "Failed write-behind flushes",
+                         lambda: {(w.name,): w.stats['errors'] for w in writes}, ("buffer",))
+    metrics.gauge("bot_limiter_limit", "Adaptive concurrency limit", lambda: {(l.name,): round(l.limit, 2) for l in limiters()}, ("name",))
+    metrics.gauge("bot_limiter_inflight", "Requests holding a limiter slot", lambda: {(l.name,): l.inflight for l in limiters()}, ("name",))
+    metrics.counter_from("bot_limiter_rejected_total", "Fail-fast rejections", lambda: {(l.name,): l.stats['rejected'] for l in limiters()}, ("name",))
+    metrics.counter_from("bot_mirror_requests_total", "Piped mirror requests",
+                         lambda: {(m.base,): m.requests for m in engine.yt.mirrors.mirrors}, ("mirror",))
+    metrics.counter_from("bot_mirror_errors_total", "Piped mirror failures",
+                         lambda: {(m.base,): m.errors for m in engine.yt.mirrors.mirrors}, ("mirror",))
+    metrics.gauge("bot_mirror_open", "Mirror circuit breaker open (1) or closed (0)",
+                  lambda: {(m['base'],): int(m['open_for'] > 0) for m in engine.yt.mirrors.snapshot()}, ("mirror",))
+    metrics.gauge("bot_api_waiting", "Bot API calls waiting for a slot", lambda: len(api.queue))
+    metrics.counter_from("bot_api_retry_after_total", "429 responses from Bot API", lambda: api.stats['retry_after'])
+    metrics.gauge("bot_library_tracks", "Tracks in the local inline index", lambda: len(library.tracks))
+    if ingress:
+        metrics.counter_from("bot_webhook_updates_total", "Webhook requests",
+                             lambda: by_key(ingress.stats), ("result",))
+        metrics.gauge("bot_webhook_inflight", "Updates being processed", lambda: len(ingress.tasks))
+    metrics.gauge("bot_startup_seconds", "Cold start: total and per step",
+                  lambda: {(step,): took for step, took in startup.items()}, ("step",))
+
+async def wait_for_stop():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass # win32
+    await stop.wait()
+
+startup = {} # шаг -> сек; 'total' - от запуска процесса до приёма апдейтов
 
+async def timed(step, aw):
+    start = time.perf_counter()
+    try: return await aw
+    finally: startup[step] = round(time.perf_counter() - start, 3)
+
+def import_bot_modules():
+    for name in BOT_MODULES: importlib.import_module(name)
+
+async def prepare_db(key_manager):
+    await init_db()
+    # Стартуем на сохранённом (или запасном) ключе; проверка и обновление - в фоне
+    await timed('sc_key', key_manager.load())
+
+def create_session():
     ssl_ctx = ssl.create_default_context()
     ssl_ctx.check_hostname = False
     ssl_ctx.verify_mode = ssl.CERT_NONE
@@ -66,31 +159,124 @@ async def main():
         resolver=resolver
     )
     
-    session = aiohttp.ClientSession(
+    return aiohttp.ClientSession(
         connector=connector, 
         json_serialize=ujson.dumps
     )
 
+async def main(worker=0):
+    gc.collect()
+    profiling.start() # лаг цикла и паузы GC видны с первых секунд старта
+    logger.info(f"🚀 Initializing Bot (worker {worker})...")
+    # Несколько процессов на одном порту - только в режиме webhook
+    processes = WORKERS if UPDATES_MODE == 'webhook' else 1
+    if processes > 1: metrics.const_labels = (('worker', worker),)
+
+    session = create_session()
     key_manager = KeyManager(session)
-    await key_manager.fetch_new_key()
-    
     engine = MultiEngine(session, key_manager)
 
+    cluster = Cluster()
+    if WORKERS > 1:
+        cluster.on('sc_key', lambda data: key_manager.adopt(data['client_id']))
+        cluster.on('mirror', engine.yt.mirrors.apply_remote)
+        key_manager.publish = lambda client_id: cluster.publish('sc_key', {'client_id': client_id})
+        engine.yt.mirrors.publish = lambda data: cluster.publish('mirror', data)
+
+    # Независимые шаги разом: импорт aiogram в потоке, база с прогревами, LISTEN кластера
+    await asyncio.gather(
+        timed('imports', asyncio.to_thread(import_bot_modules)),
+        timed('db', prepare_db(key_manager)),
+        timed('cluster', cluster.start()),
+    )
+
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.default import DefaultBotProperties
+    from botapi import BotApiScheduler
+    from handlers import router, setup_handlers, library, broadcaster
+    from webhook import WebhookIngress
+
+    bot = Bot(
+        token=TG_TOKEN, 
+        default=DefaultBotProperties(parse_mode="HTML")
+    )
+    # Все вызовы API через планировщик: лимиты Telegram, приоритеты, ожидание 429.
+    # Лимит Telegram - на бота, а планировщик у каждого процесса свой: делим поровну
+    api = BotApiScheduler(
+        BOTAPI_RATE / processes, BOTAPI_CHAT_INTERVAL, BOTAPI_MAX_RETRIES, BOTAPI_MAX_RETRY_AFTER,
+        background_chats=[CACHE_CHANNEL_ID]
+    )
+    bot.session.middleware(api)
+    dp = Dispatcher()
+
+    ingress = None
+    if UPDATES_MODE == 'webhook':
+        secret = WEBHOOK_SECRET
+        if not secret:
+            # Случайный секрет годится только для одного инстанса
+            secret = secrets.token_urlsafe(32)
+            logger.warning("⚠️ WEBHOOK_SECRET не задан, сгенерировал временный")
+        ingress = WebhookIngress(dp, bot, secret, WEBHOOK_MAX_CONCURRENT, WEBHOOK_MAX_PENDING)
+
+    # Фоновую проверку ключа ведёт один воркер, остальные узнают о новом ключе через NOTIFY
+    if worker == 0: key_manager.start()
+    engine.yt.mirrors.start()
+    # Протухшие выдачи общего кэша чистит один воркер
+    if worker == 0: engine.start_purge()
+
     setup_handlers(engine, bot) 
     dp.include_router(router)
+    register_metrics(engine, api, ingress)
+    tracing.start()
+
+    runners = [await timed('web', start_web_server(ingress))]
+    if processes > 1 and METRICS_PORT: runners.append(await start_metrics_server(worker))
+    # Прогревы - в фоне после старта: индекс отвечает и недогруженным, промах L1 идёт в базу
+    warmups = [
+        asyncio.create_task(timed('library', library.load(iter_cached_tracks()))),
+        asyncio.create_task(timed('file_cache_warm', warm_file_cache(FILE_CACHE_WARM))),
+    ]
+    # Рассылка, прерванная рестартом/деплоем, продолжается с сохранённого места
+    if worker == 0: await broadcaster.resume()
 
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logger.info("✅ Bot Started & Polling...")
-        await dp.start_polling(bot)
+        if ingress:
+            ingress.accepting = True
+            if worker == 0:
+                await bot.set_webhook(
+                    f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                    secret_token=ingress.secret.decode(),
+                    allowed_updates=dp.resolve_used_update_types(),
+                    # Не дропаем: при деплое за балансером другие инстансы ещё работают
+                    drop_pending_updates=False
+                )
+            ready(worker)
+            logger.info("✅ Bot Started & Webhook...")
+            await wait_for_stop()
+            await ingress.drain(WEBHOOK_DRAIN_TIMEOUT)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            ready(worker)
+            logger.info("✅ Bot Started & Polling...")
+            await dp.start_polling(bot)
     finally:
+        for task in warmups: task.cancel()
+        for runner in runners: await runner.cleanup()
+        await cluster.close()
         await session.close()
         await bot.session.close()
-        if pool:
-            await pool.close()
+        await tracing.stop()
+        if database.pool:
+            await database.flush_writes()
+            await database.pool.close()
         logger.info("📴 Shutdown complete")
 
-if __name__ == "__main__":
+def ready(worker):
+    startup['total'] = round(time.perf_counter() - STARTED, 3)
+    steps = ", ".join(f"{step} {took}с" for step, took in startup.items() if step != 'total')
+    logger.info(f"⏱ Воркер {worker} готов за {startup['total']}с ({steps})")
+
+def run_worker(worker=0):
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     else:
@@ -101,6 +287,17 @@ if __name__ == "__main__":
         except ImportError: pass
     
     try:
-        asyncio.run(main())
+        asyncio.run(main(worker))
     except (KeyboardInterrupt, SystemExit):
-        pass
\ No newline at end of file
+        pass
+
+if __name__ == "__main__":
+    if WORKERS > 1 and UPDATES_MODE == 'webhook':
+        # Секрет должен совпадать у всех воркеров: дочерние процессы читают его из окружения
+        if not WEBHOOK_SECRET: os.environ["WEBHOOK_SECRET"] = secrets.token_urlsafe(32)
+        run_supervisor(WORKERS, run_worker)
+    else:
+        if WORKERS > 1:
+            # getUpdates может тянуть только один процесс
+            logger.warning("⚠️ WORKERS > 1 работает только с UPDATES_MODE=webhook, запускаю один процесс")
+        run_worker()
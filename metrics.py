@@ -0,0 +1,138 @@
+import bisect
+import time
+from aiohttp import web
+import tracing
+
+# Текстовый формат Prometheus без зависимостей. В горячем пути только observe/inc:
+# bisect по корзинам и пара сложений; снапшоты подсистем собираются лишь при скрейпе.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry = []
+# Метки на каждой серии процесса. При WORKERS > 1 main ставит номер воркера:
+# скрейп через общий порт попадает в случайный процесс, и без метки счётчики "прыгают"
+const_labels = ()
+
+def _labels(names, values):
+    pairs = (*const_labels, *zip(names, values))
+    if not pairs: return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in pairs) + "}"
+
+class Histogram:
+    __slots__ = ('name', 'help', 'labels', 'buckets', 'series')
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {} # значения меток -> [счётчики корзин..., +Inf], сумма
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, (counts, total) in self.series.items():
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), values + (bound,))} {running}"
+            running += counts[-1]
+            yield f"{self.name}_bucket{_labels(self.labels + ('le',), values + ('+Inf',))} {running}"
+            yield f"{self.name}_sum{_labels(self.labels, values)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, values)} {running}"
+
+class Timer:
+    """with HISTOGRAM.time('stage'): ... - наблюдает и при исключении; заодно спан в текущую трассу"""
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.histogram.observe(end - self.start, *self.labels)
+        tracing.add(self.labels[0] if self.labels else self.histogram.name, self.start, end)
+
+class Counter:
+    __slots__ = ('name', 'help', 'labels', 'values')
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *labels, n=1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, n in self.values.items():
+            yield f"{self.name}{_labels(self.labels, values)} {n}"
+
+class Sampled:
+    """Значения, которые подсистемы уже считают сами (stats/snapshot): читаем при скрейпе.
+    fn() -> число или {значения меток (tuple): число}"""
+    __slots__ = ('name', 'help', 'kind', 'labels', 'fn')
+
+    def __init__(self, name, help, kind, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind # gauge | counter
+        self.labels = labels
+        self.fn = fn
+        registry.append(self)
+
+    def render(self):
+        try: data = self.fn()
+        except Exception: return # подсистема ещё не поднята
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        if not isinstance(data, dict):
+            yield f"{self.name}{_labels((), ())} {data}"
+            return
+        for values, n in data.items():
+            yield f"{self.name}{_labels(self.labels, values)} {n}"
+
+def gauge(name, help, fn, labels=()):
+    return Sampled(name, help, "gauge", fn, labels)
+
+def counter_from(name, help, fn, labels=()):
+    return Sampled(name, help, "counter", fn, labels)
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+# --- Общие метрики (наблюдаются в разных модулях) ---
+
+ENGINE_SECONDS = Histogram("bot_engine_seconds", "Search latency per engine", ("engine",))
+UPSTREAM_SECONDS = Histogram("bot_upstream_seconds", "HTTP latency per upstream host", ("host",))
+CLICK_STAGE_SECONDS = Histogram(
+    "bot_click_stage_seconds", "process_track stages: cache, resolve, upload, edit", ("stage",)
+)
+SC_KEY_EVENTS = Counter("bot_sc_key_events_total", "SoundCloud 401s and key refresh outcomes", ("event",))
+TELEGRAM_ERRORS = Counter("bot_telegram_errors_total", "Bot API errors by method and type", ("method", "error"))
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import random
+from collections import deque
+from limiter import LimiterFull, hosts
+from config import (
+    MIRROR_EWMA_ALPHA, MIRROR_FAIL_THRESHOLD, MIRROR_COOLDOWN, MIRROR_COOLDOWN_MAX,
+    MIRROR_PROBE_INTERVAL, MIRROR_PROBE_PATH, MIRROR_HEDGE_MIN, MIRROR_HEDGE_DEFAULT
+)
+
+logger = logging.getLogger("MIRRORS")
+
+BUSY = object() # _attempt: лимитер хоста отказал, зеркало не спрашивали
+
+class Mirror:
+    __slots__ = ('base', 'latency', 'success', 'fails', 'cooldown', 'open_until',
+                 'samples', 'requests', 'errors', 'hedges')
+
+    def __init__(self, base):
+        self.base = base
+        self.latency = MIRROR_HEDGE_DEFAULT / 2 # EWMA, сек (оптимистичный старт)
+        self.success = 1.0 # EWMA доли успешных ответов
+        self.fails = 0 # неудачи подряд
+        self.cooldown = MIRROR_COOLDOWN
+        self.open_until = 0.0 # circuit breaker: пока > now - зеркало не трогаем
+        self.samples = deque(maxlen=50) # последние успешные латентности для p90
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+
+    def score(self):
+        # Меньше - лучше: медленное или часто падающее зеркало уходит в конец
+        return self.latency / max(self.success, 0.05)
+
+    def p90(self):
+        if len(self.samples) < 5: return MIRROR_HEDGE_DEFAULT
+        ordered = sorted(self.samples)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+class MirrorPool:
+    """Пул Piped-зеркал: EWMA здоровья, circuit breaker, фоновые пробы и hedged запросы"""
+
+    def __init__(self, session, mirrors):
+        self.session = session
+        self.mirrors = [Mirror(base) for base in mirrors]
+        self.probe_task = None
+        self.publish = None # callback(dict): поделиться состоянием зеркала с другими воркерами
+
+    def start(self):
+        if self.probe_task is None:
+            self.probe_task = asyncio.create_task(self._probe_loop())
+
+    def ranked(self):
+        mirrors = self.mirrors.copy()
+        random.shuffle(mirrors) # при равных очках нагрузка размазывается
+        # Выключенное зеркало возвращается только после успешной пробы (fails сбросится)
+        alive = [m for m in mirrors if m.fails < MIRROR_FAIL_THRESHOLD]
+        # Если все в ауте - лучше попробовать, чем сразу сдаться
+        if not alive: alive = sorted(mirrors, key=lambda m: m.open_until)
+        return sorted(alive, key=Mirror.score)
+
+    def record(self, m, ok, latency):
+        a = MIRROR_EWMA_ALPHA
+        m.requests += 1
+        m.success = (1 - a) * m.success + a * (1.0 if ok else 0.0)
+        if ok:
+            m.latency = (1 - a) * m.latency + a * latency
+            m.samples.append(latency)
+            m.fails = 0
+            m.cooldown = MIRROR_COOLDOWN
+            return
+        m.errors += 1
+        m.fails += 1
+        if m.fails >= MIRROR_FAIL_THRESHOLD and m.open_until <= asyncio.get_running_loop().time():
+            self._open(m)
+
+    def _open(self, m):
+        m.open_until = asyncio.get_running_loop().time() + m.cooldown
+        logger.warning(f"🔌 {m.base}: выключено на {m.cooldown:.0f}с ({m.fails} ошибок подряд)")
+        if self.publish: self.publish({'base': m.base, 'open_for': m.cooldown})
+        m.cooldown = min(m.cooldown * 2, MIRROR_COOLDOWN_MAX)
+
+    def apply_remote(self, data):
+        """Другой воркер выключил зеркало (open_for > 0) или вернул его после пробы"""
+        m = next((m for m in self.mirrors if m.base == data.get('base')), None)
+        if m is None: return
+        if data.get('open_for'):
+            m.fails = max(m.fails, MIRROR_FAIL_THRESHOLD)
+            m.open_until = max(m.open_until, asyncio.get_running_loop().time() + data['open_for'])
+        else:
+            m.fails = 0
+            m.open_until = 0.0
+            m.cooldown = MIRROR_COOLDOWN
+
+    async def fetch(self, path, handler, params=None, timeout=3, priority=False):
+        """handler(base, resp) -> результат или None (None = зеркало не справилось, идём дальше).
+        Если лучшее зеркало отвечает дольше своего p90, параллельно спрашиваем следующее.
+        LimiterFull - если ни одно зеркало не приняло запрос (перегрузка у нас, а не сбой зеркал)"""
+        order = iter(self.ranked())
+        running = {}
+        attempts = busy = 0
+
+        def launch():
+            nonlocal attempts
+            m = next(order, None)
+            if m is None: return False
+            attempts += 1
+            t = asyncio.create_task(self._attempt(m, path, params, timeout, handler, priority))
+            running[t] = m
+            return True
+
+        launch()
+        can_hedge = True
+        try:
+            while running:
+                hedge_after = None
+                if can_hedge and len(running) == 1:
+                    hedge_after = max(next(iter(running.values())).p90(), MIRROR_HEDGE_MIN)
+                done, _ = await asyncio.wait(running, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    slow = next(iter(running.values()))
+                    if launch(): slow.hedges += 1
+                    else: can_hedge = False
+                    continue
+                for t in done:
+                    running.pop(t)
+                    result = t.result()
+                    if result is BUSY: busy += 1
+                    elif result is not None: return result
+                    if not running: launch()
+        finally:
+            for t in running: t.cancel()
+        if attempts and busy == attempts: raise LimiterFull("mirrors")
+        return None
+
+    async def _attempt(self, m, path, params, timeout, handler, priority):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            async with hosts.for_url(m.base).slot(priority) as slot:
+                async with self.session.get(f"{m.base}{path}", params=params, timeout=timeout) as resp:
+                    if resp.status == 429 or resp.status >= 500: slot.fail()
+                    result = await handler(m.base, resp)
+        except LimiterFull:
+            # Зеркало не ломалось, просто занято - идём к следующему без штрафа
+            return BUSY
+        except asyncio.CancelledError:
+            # Проигравший hedge - не ошибка, но время ожидания - нижняя оценка латентности
+            elapsed = loop.time() - start
+            if elapsed > m.latency:
+                m.latency = (1 - MIRROR_EWMA_ALPHA) * m.latency + MIRROR_EWMA_ALPHA * elapsed
+            raise
+        except Exception:
+            result = None
+        self.record(m, result is not None, loop.time() - start)
+        return result
+
+    async def _probe_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(MIRROR_PROBE_INTERVAL)
+            now = loop.time()
+            # Полуоткрытое состояние: кулдаун вышел - проверяем пробой, а не юзерским запросом
+            due = [m for m in self.mirrors if m.fails >= MIRROR_FAIL_THRESHOLD and m.open_until <= now]
+            if due: await asyncio.gather(*(self._probe(m) for m in due))
+
+    async def _probe(self, m):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        ok = False
+        try:
+            async with self.session.get(f"{m.base}{MIRROR_PROBE_PATH}", timeout=3) as resp:
+                ok = resp.status == 200
+        except Exception: pass
+        if ok:
+            logger.info(f"🔌 {m.base}: проба успешна, возвращаю в ротацию")
+            self.record(m, True, loop.time() - start)
+            if self.publish: self.publish({'base': m.base, 'open_for': 0})
+        else:
+            self._open(m)
+
+    def snapshot(self):
+        now = asyncio.get_running_loop().time()
+        return [{
+            'base': m.base,
+            'latency_ewma': round(m.latency, 3),
+            'p90': round(m.p90(), 3),
+            'success_ewma': round(m.success, 3),
+            'requests': m.requests,
+            'errors': m.errors,
+            'hedges': m.hedges,
+            'open_for': round(max(m.open_until - now, 0), 1),
+        } for m in self.mirrors]
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from cachetools import TTLCache
+from utils import normalize_query
+
+logger = logging.getLogger("PREFETCH")
+
+class Prefetcher:
+    """Фоновая подготовка топ-K результатов инлайн-выдачи до клика.
+    mode: 'off' | 'resolve' (только достать ссылку) | 'upload' (сразу залить в кэш-канал)"""
+
+    def __init__(self, mode, top_k, min_popularity, per_minute, max_inflight, window):
+        self.mode = mode
+        self.top_k = top_k
+        self.min_popularity = min_popularity
+        self.per_minute = per_minute
+        self.max_inflight = max_inflight
+        self.window = window # сек, в течение которых ждём клик по подготовленному треку
+        self.popularity = TTLCache(maxsize=20000, ttl=600) # нормализованный запрос -> сколько раз искали
+        self.resolved = TTLCache(maxsize=1000, ttl=min(window, 120)) # ссылки быстро протухают
+        self.prepared = {} # (source, id) -> (время, байты); ещё не кликнутые
+        self.inflight = set()
+        self.working = set() # (source, id), которые готовятся прямо сейчас
+        self.tokens = float(per_minute)
+        self.refilled_at = time.monotonic()
+        self.is_cached = self.resolve = self.upload = self.has_room = None
+        self.stats = {'prefetched': 0, 'hits': 0, 'wasted': 0, 'bytes': 0, 'wasted_bytes': 0,
+                      'failed': 0, 'skipped_budget': 0}
+
+    def bind(self, is_cached, resolve, upload, has_room):
+        self.is_cached, self.resolve, self.upload, self.has_room = is_cached, resolve, upload, has_room
+
+    def schedule(self, query, results):
+        """Вызывается после ответа на InlineQuery; не блокирует"""
+        if self.mode == 'off' or not results: return
+        key = normalize_query(query)
+        seen = self.popularity.get(key, 0) + 1
+        self.popularity[key] = seen
+        # Чем популярнее запрос, тем глубже готовим выдачу
+        depth = min(self.top_k, seen - self.min_popularity + 1)
+        if depth <= 0: return
+        task = asyncio.create_task(self._run([c.key for c in results[:depth]]))
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    def _take_token(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.refilled_at) * self.per_minute / 60)
+        self.refilled_at = now
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+    async def _run(self, keys):
+        self._sweep()
+        for source, item_id in keys:
+            key = (source, item_id)
+            if key in self.prepared or key in self.resolved or key in self.working: continue
+            if len(self.inflight) > self.max_inflight or not self.has_room() or not self._take_token():
+                self.stats['skipped_budget'] += 1
+                return
+            self.working.add(key)
+            try:
+                if await self.is_cached(source, item_id): continue
+                size = await self._prepare(source, item_id)
+            finally:
+                self.working.discard(key)
+            if size is None:
+                self.stats['failed'] += 1
+                continue
+            self.prepared[key] = (time.monotonic(), size)
+            self.stats['prefetched'] += 1
+            self.stats['bytes'] += size
+
+    async def _prepare(self, source, item_id):
+        try:
+            if self.mode == 'upload':
+                return await self.upload(source, item_id)
+            track = await self.resolve(source, item_id)
+            if not track: return None
+            self.resolved[(source, item_id)] = track
+            return 0
+        except Exception as e:
+            logger.warning(f"🔮 {source} {item_id}: {e}")
+            return None
+
+    def take_resolved(self, source, item_id):
+        return self.resolved.pop((source, item_id), None)
+
+    def on_click(self, source, item_id):
+        if self.prepared.pop((source, item_id), None) is not None:
+            self.stats['hits'] += 1
+
+    def _sweep(self):
+        # Не кликнули за окно - трафик потрачен зря
+        deadline = time.monotonic() - self.window
+        for key in [k for k, (t, _) in self.prepared.items() if t < deadline]:
+            _, size = self.prepared.pop(key)
+            self.stats['wasted'] += 1
+            self.stats['wasted_bytes'] += size
+
+    def counters(self):
+        """stats для /metrics: просроченные списываем при скрейпе - при слабом трафике
+        schedule() вызывается редко, и wasted иначе отстаёт"""
+        self._sweep()
+        return self.stats
+
+    def snapshot(self):
+        self._sweep()
+        done = self.stats['prefetched']
+        return {
+            'mode': self.mode,
+            **self.stats,
+            'pending': len(self.prepared),
+            'inflight': len(self.inflight),
+            'hit_ratio': self.stats['hits'] / done if done else 0.0,
+        }
@@ -0,0 +1,266 @@
+import asyncio
+import gc
+import hmac
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from aiohttp import web
+from config import DEBUG_TOKEN, PROFILE_MAX_SECONDS, PROFILE_INTERVAL, LOOP_LAG_INTERVAL
+from metrics import Histogram
+
+# Диагностика под живой нагрузкой без рестарта: /debug/* на том же aiohttp, только с DEBUG_TOKEN.
+# При WORKERS > 1 запрос попадает в случайный воркер - pid есть в ответе.
+
+logger = logging.getLogger("PROFILING")
+
+PAUSE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+LOOP_LAG_SECONDS = Histogram("bot_loop_lag_seconds", "Event loop lag: timer overshoot", buckets=PAUSE_BUCKETS)
+GC_PAUSE_SECONDS = Histogram("bot_gc_pause_seconds", "Garbage collector pauses", ("generation",), buckets=PAUSE_BUCKETS)
+
+# --- ЛАГ ЦИКЛА ---
+
+class LoopMonitor:
+    """Спим interval и меряем, насколько проснулись позже: столько же ждал любой колбэк"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = deque(maxlen=int(60 / interval)) # последняя минута
+        self.max = 0.0
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.samples.append(lag)
+            self.max = max(self.max, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+
+    def snapshot(self):
+        ordered = sorted(self.samples)
+        pick = lambda q: round(ordered[int(q * (len(ordered) - 1))] * 1000, 2) if ordered else None
+        return {
+            'interval_ms': self.interval * 1000, 'window_s': round(len(ordered) * self.interval, 1),
+            'p50_ms': pick(0.5), 'p99_ms': pick(0.99), 'max_1m_ms': pick(1.0),
+            'max_ms': round(self.max * 1000, 2), 'tasks': len(asyncio.all_tasks()),
+        }
+
+# --- GC ---
+
+class GcMonitor:
+    """Паузы сборщика по поколениям через gc.callbacks"""
+
+    def __init__(self):
+        self.started = None
+        self.pauses = {g: {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'collected': 0} for g in range(3)}
+        self.recent = deque(maxlen=50) # (ts, поколение, мс, собрано)
+        self.installed = False
+
+    def install(self):
+        if not self.installed:
+            gc.callbacks.append(self._callback)
+            self.installed = True
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self.started = time.perf_counter()
+            return
+        if self.started is None: return
+        pause = time.perf_counter() - self.started
+        self.started = None
+        generation = info['generation']
+        stats = self.pauses[generation]
+        stats['count'] += 1
+        stats['total_ms'] += pause * 1000
+        stats['max_ms'] = max(stats['max_ms'], pause * 1000)
+        stats['collected'] += info['collected']
+        self.recent.append((round(time.time(), 3), generation, round(pause * 1000, 3), info['collected']))
+        GC_PAUSE_SECONDS.observe(pause, str(generation))
+
+    def snapshot(self):
+        return {
+            'enabled': gc.isenabled(), 'count': gc.get_count(), 'threshold': gc.get_threshold(),
+            'stats': gc.get_stats(), 'garbage': len(gc.garbage), 'frozen': gc.get_freeze_count(),
+            'pauses': {g: {**s, 'total_ms': round(s['total_ms'], 3), 'max_ms': round(s['max_ms'], 3)}
+                       for g, s in self.pauses.items()},
+            'recent': list(self.recent),
+        }
+
+# --- CPU ---
+
+class SamplingProfiler:
+    """SIGPROF раз в interval процессорного времени: обработчик выполняется в главном потоке
+    (там же event loop) и получает прерванный кадр. Сэмплер из соседнего потока не годится:
+    GIL ему достаётся, когда цикл сам его отпускает - в select, и профиль показывает один простой.
+    Результат - свёрнутые стеки (folded: "a;b;c count"), их читают speedscope, flamegraph.pl и inferno"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = Counter()
+        self.labels = {} # code -> подпись: не форматируем одно и то же на каждом сэмпле
+        self.samples = 0
+        self.previous = None
+
+    def label(self, code):
+        name = self.labels.get(code)
+        if name is None:
+            name = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return name
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self.label(frame.f_code))
+            frame = frame.f_back
+        self.counts[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {n}\n" for stack, n in self.counts.most_common())
+
+# --- TRACEMALLOC ---
+
+TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+
+def _diff_report(snapshot, previous, top, key):
+    total = sum(s.size for s in snapshot.statistics('filename'))
+    lines = [f"traced: {total / 1024 / 1024:.1f} MiB, pid {os.getpid()}"]
+    if previous is None:
+        lines.append(f"top {top} by {key}:")
+        lines += [str(s) for s in snapshot.statistics(key)[:top]]
+    else:
+        lines.append(f"top {top} by {key}, diff vs previous snapshot:")
+        lines += [str(s) for s in snapshot.compare_to(previous, key)[:top]]
+    return "\n".join(lines) + "\n"
+
+def _dump(snapshot):
+    # Формат tracemalloc.Snapshot.load: открывается тем же модулем на любой машине
+    with tempfile.NamedTemporaryFile(suffix=".tracemalloc", delete=False) as f:
+        path = f.name
+    try:
+        snapshot.dump(path)
+        with open(path, "rb") as f: return f.read()
+    finally:
+        os.unlink(path)
+
+# --- ЭНДПОИНТЫ ---
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL)
+gc_monitor = GcMonitor()
+profile_lock = asyncio.Lock()
+last_snapshot = None
+
+def start():
+    gc_monitor.install()
+    loop_monitor.start()
+
+def admin_only(handler):
+    async def wrapped(request):
+        # Без токена эндпоинтов нет вовсе - и снаружи не видно, что они существуют
+        if not DEBUG_TOKEN: raise web.HTTPNotFound()
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ").encode()
+        if not hmac.compare_digest(token, DEBUG_TOKEN.encode()): raise web.HTTPForbidden()
+        return await handler(request)
+    return wrapped
+
+def _number(request, name, default, cast=float):
+    try: return cast(request.query.get(name, default))
+    except ValueError: raise web.HTTPBadRequest(text=f"bad {name}")
+
+def _attachment(body, filename, content_type):
+    return web.Response(body=body, content_type=content_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
+
+@admin_only
+async def profile_handler(request):
+    """GET /debug/profile?seconds=10&interval_ms=5 -> cpu-<pid>-<ts>.folded"""
+    seconds = min(_number(request, 'seconds', 10), PROFILE_MAX_SECONDS)
+    interval = max(_number(request, 'interval_ms', PROFILE_INTERVAL * 1000), 1) / 1000
+    if not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        raise web.HTTPNotImplemented(text="SIGPROF sampling needs the loop in the main thread on unix")
+    if profile_lock.locked(): raise web.HTTPConflict(text="profile already running")
+    async with profile_lock:
+        profiler = SamplingProfiler(interval)
+        logger.info(f"🔬 CPU профиль на {seconds:.0f}с")
+        profiler.start()
+        try: await asyncio.sleep(seconds)
+        finally: profiler.stop()
+    # Таймер считает процессорное время: простой цикла в профиль не попадает
+    return _attachment(profiler.folded().encode(), f"cpu-{os.getpid()}-{int(time.time())}.folded", "text/plain")
+
+@admin_only
+async def tracemalloc_start_handler(request):
+    """GET /debug/tracemalloc/start?frames=25 - трассировка дорогая, включаем только на время расследования"""
+    frames = _number(request, 'frames', 25, int)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        logger.info(f"🔬 tracemalloc включён ({frames} кадров)")
+    return web.json_response({'tracing': True, 'frames': tracemalloc.get_traceback_limit()})
+
+@admin_only
+async def tracemalloc_stop_handler(request):
+    global last_snapshot
+    tracemalloc.stop()
+    last_snapshot = None
+    return web.json_response({'tracing': False})
+
+@admin_only
+async def tracemalloc_snapshot_handler(request):
+    """GET /debug/tracemalloc/snapshot?top=30&key=lineno - текстовый топ (разница с прошлым снимком);
+    &download=1 - сам снимок для tracemalloc.Snapshot.load"""
+    global last_snapshot
+    if not tracemalloc.is_tracing(): raise web.HTTPConflict(text="tracemalloc is not started")
+    top = _number(request, 'top', 30, int)
+    key = request.query.get('key', 'lineno')
+    if key not in ('lineno', 'filename', 'traceback'): raise web.HTTPBadRequest(text="bad key")
+    snapshot = await asyncio.to_thread(_take_snapshot)
+    if request.query.get('download'):
+        body = await asyncio.to_thread(_dump, snapshot)
+        return _attachment(body, f"heap-{os.getpid()}-{int(time.time())}.tracemalloc", "application/octet-stream")
+    previous, last_snapshot = last_snapshot, snapshot
+    return web.Response(text=await asyncio.to_thread(_diff_report, snapshot, previous, top, key))
+
+@admin_only
+async def gc_handler(request):
+    return web.json_response({'pid': os.getpid(), **gc_monitor.snapshot()})
+
+@admin_only
+async def loop_handler(request):
+    return web.json_response({'pid': os.getpid(), **loop_monitor.snapshot()})
+
+routes = [
+    web.get('/debug/profile', profile_handler),
+    web.get('/debug/tracemalloc/start', tracemalloc_start_handler),
+    web.get('/debug/tracemalloc/stop', tracemalloc_stop_handler),
+    web.get('/debug/tracemalloc/snapshot', tracemalloc_snapshot_handler),
+    web.get('/debug/gc', gc_handler),
+    web.get('/debug/loop', loop_handler),
+]
@@ -0,0 +1,80 @@
+import math
+import re
+from operator import attrgetter
+from config import BANNED_WORDS
+from utils import clean_query
+
+WORD_RE = re.compile(r'\w+')
+
+def _compile_banned(words):
+    # Lookahead на каждой позиции ловит и пересекающиеся вхождения; альтернативы от длинных
+    # к коротким, а короткие слова, входящие в найденное длинное, добавляем через implied
+    ordered = sorted(words, key=len, reverse=True)
+    pattern = re.compile("(?=(" + "|".join(map(re.escape, ordered)) + "))")
+    implied = {w: frozenset(o for o in words if o in w) for w in words}
+    return pattern, implied
+
+BANNED_RE, BANNED_IMPLIED = _compile_banned(BANNED_WORDS)
+by_score = attrgetter('score')
+
+def banned_in(text):
+    """Множество запрещённых слов, входящих в text подстрокой (один проход regex)"""
+    found = set()
+    for m in BANNED_RE.finditer(text):
+        found |= BANNED_IMPLIED[m.group(1)]
+    return found
+
+class QueryRanker:
+    """Запрос, разобранный один раз: дальше скорим им сколько угодно кандидатов (candidate.Candidate)"""
+    __slots__ = ('query_clean', 'query_words', 'is_clean_search')
+
+    def __init__(self, query_raw):
+        self.query_clean = clean_query(query_raw)
+        self.query_words = frozenset(self.query_clean.split())
+        self.is_clean_search = BANNED_RE.search(self.query_clean) is None
+
+    def score(self, item):
+        query_words = self.query_words
+        if not query_words: return 0
+
+        title_lower = item.title.lower()
+        full_text = f"{item.artist.lower()} {title_lower}"
+
+        # 1 СОВПАДЕНИЕ СЛОВ
+        common = len(query_words.intersection(WORD_RE.findall(full_text)))
+        if not common: return -100
+        coverage = common / len(query_words)
+
+        if coverage == 1.0: score = 300
+        elif coverage >= 0.66: score = 100
+        else: score = 50
+
+        # 2 ТОЧНАЯ ФРАЗА
+        if self.query_clean in full_text:
+            score += 100
+
+        # 3 ПОПУЛЯРНОСТЬ
+        plays = item.playback_count or 0
+        if plays > 0:
+            try:
+                score += math.log10(plays) * 20
+            except: pass
+
+        # 4 ШТРАФЫ
+        dur = (item.duration or 0) / 1000
+        if dur < 40: score -= 50
+        elif dur > 900: score -= 30
+
+        if self.is_clean_search:
+            for _ in banned_in(title_lower):
+                score -= 50
+
+        return score
+
+    def rank(self, items):
+        """Проставляет item.score и сортирует на месте (стабильно, как раньше)"""
+        score = self.score
+        for item in items:
+            item.score = score(item)
+        items.sort(key=by_score, reverse=True)
+        return items
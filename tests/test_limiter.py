@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from limiter import AdaptiveLimiter
+
+
+async def _queued_waiter(limiter, priority):
+    await limiter.acquire()  # занимаем единственный слот
+    waiter = asyncio.create_task(limiter.acquire(priority))
+    await asyncio.sleep(0)  # waiter встал в очередь
+    return waiter
+
+
+@pytest.mark.parametrize("priority", [False, True])
+def test_cancel_after_wake_skipped_waiter(priority):
+    """Отмена, а до пробуждения задачи _wake уже выкинул отменённый future из очереди"""
+    async def run():
+        limiter = AdaptiveLimiter("test", initial=1, max_queue=4)
+        waiter = await _queued_waiter(limiter, priority)
+        waiter.cancel()
+        limiter.release()  # _wake снимает отменённый future и пропускает его
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.inflight == 0
+        assert not limiter.waiters and not limiter.urgent
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("priority", [False, True])
+def test_cancel_after_wake_granted_slot(priority):
+    """Слот уже выдали, а задачу отменили раньше, чем она проснулась - слот возвращается"""
+    async def run():
+        limiter = AdaptiveLimiter("test", initial=1, max_queue=4)
+        waiter = await _queued_waiter(limiter, priority)
+        limiter.release()  # _wake выдаёт слот ждущему
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.inflight == 0
+        assert not limiter.waiters and not limiter.urgent
+    asyncio.run(run())
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import ujson
+from collections import deque
+from contextvars import ContextVar
+from cachetools import TTLCache
+from config import TRACE_FILE, TRACE_FILE_MAX, TRACE_SAMPLE, TRACE_SLOW, TRACE_KEEP, TRACE_WINDOW
+
+# Трасса запроса: инлайн-запрос -> поиск -> HTTP движков; клик -> кэш -> загрузка -> правка сообщения.
+# Текущая трасса живёт в contextvar: задачи, созданные внутри (поиск, debounce), подхватывают её сами.
+# Без активной трассы add/span - один get() из contextvar.
+
+logger = logging.getLogger("TRACING")
+
+MAX_SPANS = 200 # на трассу: хеджи и ретраи не должны раздувать память
+
+current = ContextVar('trace', default=None)
+recent = deque(maxlen=TRACE_KEEP) # законченные трассы для /traces
+latest = TTLCache(maxsize=20000, ttl=TRACE_WINDOW) # (user, kind) -> id последней трассы
+pending = [] # строки jsonl, ждущие записи
+writer_task = None
+
+class Trace:
+    __slots__ = ('id', 'kind', 'user', 'parent', 'attrs', 'ts', 'start', 'duration', 'spans', 'token')
+
+    def __init__(self, kind, user=None, parent=None, **attrs):
+        self.id = os.urandom(6).hex()
+        self.kind = kind
+        self.user = user
+        self.parent = parent # id инлайн-запроса, из выдачи которого кликнули
+        self.attrs = attrs
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = [] # (имя, начало от старта трассы, длительность, доп. поля или None)
+
+    def __enter__(self):
+        self.token = current.set(self)
+        if self.user is not None: latest[(self.user, self.kind)] = self.id
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current.reset(self.token)
+        if exc_type is asyncio.CancelledError: self.attrs['cancelled'] = True
+        elif exc_type is not None: self.attrs['error'] = exc_type.__name__
+        finish(self)
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'kind': self.kind, 'user': self.user, 'parent': self.parent,
+            'ts': round(self.ts, 3), 'ms': ms(self.duration), **self.attrs,
+            'spans': [{'name': name, 'at': ms(at), 'ms': ms(took), **(extra or {})}
+                      for name, at, took, extra in self.spans],
+        }
+
+def ms(seconds):
+    return round(seconds * 1000, 1)
+
+def trace(kind, user=None, parent=None, **attrs):
+    """with trace('click', user_id, track=...): ... - корневая трасса запроса"""
+    return Trace(kind, user, parent, **attrs)
+
+def last_of(user, kind):
+    return latest.get((user, kind))
+
+def add(name, start, end=None, **extra):
+    """Спан по уже измеренным perf_counter() отметкам"""
+    t = current.get()
+    if t is None or t.duration is not None or len(t.spans) >= MAX_SPANS: return
+    if end is None: end = time.perf_counter()
+    t.spans.append((name, start - t.start, end - start, extra or None))
+
+def tag(key, value):
+    t = current.get()
+    if t is not None and t.duration is None: t.attrs[key] = value
+
+class span:
+    """with span('db'): ... - спан в текущую трассу (если она есть)"""
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add(self.name, self.start)
+
+def bind(name, factory):
+    """factory для чужой задачи (очередь загрузок): выполнится в этой трассе,
+    время в очереди - отдельный спан"""
+    t = current.get()
+    if t is None: return factory
+    queued = time.perf_counter()
+
+    async def run():
+        token = current.set(t)
+        try:
+            add(name, queued)
+            return await factory()
+        finally:
+            current.reset(token)
+    return run
+
+def finish(t):
+    t.duration = time.perf_counter() - t.start
+    recent.append(t)
+    # Хвост пишем всегда, остальное - выборкой
+    if TRACE_FILE and (t.duration >= TRACE_SLOW or random.random() < TRACE_SAMPLE):
+        pending.append(ujson.dumps(t.to_dict(), ensure_ascii=False))
+
+def slowest(n=5, kind=None):
+    since = time.time() - TRACE_WINDOW
+    found = [t for t in recent if t.ts >= since and (kind is None or t.kind == kind)]
+    return sorted(found, key=lambda t: t.duration, reverse=True)[:n]
+
+def format_trace(t):
+    head = f"🐢 {ms(t.duration):.0f}мс {t.kind} #{t.id}"
+    if t.parent: head += f" ← #{t.parent}"
+    attrs = " ".join(f"{k}={v}" for k, v in t.attrs.items())
+    lines = [head + (f"\n{attrs}" if attrs else "")]
+    for name, at, took, extra in t.spans:
+        line = f"  +{ms(at):.0f} {name} {ms(took):.0f}мс"
+        if extra: line += " " + " ".join(f"{k}={v}" for k, v in extra.items())
+        lines.append(line)
+    return "\n".join(lines)
+
+def start():
+    global writer_task
+    if TRACE_FILE and writer_task is None:
+        writer_task = asyncio.create_task(_writer_loop())
+
+async def _writer_loop():
+    while True:
+        await asyncio.sleep(5)
+        await flush()
+
+async def flush():
+    if not pending: return
+    batch = "\n".join(pending) + "\n"
+    pending.clear()
+    try:
+        await asyncio.to_thread(_write, batch)
+    except Exception as e:
+        logger.warning(f"🧵 Не удалось записать трассы: {e}")
+
+def _write(batch):
+    # Одна запись на пачку: воркеры пишут в один файл с O_APPEND, строки не перемешиваются
+    try:
+        if os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX: os.replace(TRACE_FILE, TRACE_FILE + ".1")
+    except FileNotFoundError: pass
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        f.write(batch)
+
+async def stop():
+    global writer_task
+    if writer_task is not None:
+        writer_task.cancel()
+        writer_task = None
+    await flush()
@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from metrics import Histogram
+
+logger = logging.getLogger("TRANSFERS")
+
+TRANSFER_WAIT_SECONDS = Histogram("bot_transfer_wait_seconds", "Time a transfer waits in the queue for a worker", ("priority",))
+
+# Меньше - важнее
+PRIORITY_RETRY = 0 # явный клик по кнопке f: - юзер уже ждёт и жмёт ещё раз
+PRIORITY_CHOSEN = 1 # chosen_inline_result
+PRIORITY_PREFETCH = 2 # догадка, что кликнут; уступает всем живым кликам
+
+class TransferBusy(Exception):
+    """Очередь загрузок переполнена"""
+
+class Job:
+    __slots__ = ('key', 'factory', 'future', 'priority', 'enqueued_at', 'started')
+
+    def __init__(self, key, factory, priority):
+        self.key = key
+        self.factory = factory
+        self.future = asyncio.get_running_loop().create_future()
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.started = False
+
+class TransferScheduler:
+    """Пул воркеров для скачивания/заливки с ограниченной очередью и приоритетами.
+    Задачи с одинаковым key склеиваются: все получают один результат."""
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue = asyncio.PriorityQueue()
+        self.seq = itertools.count() # FIFO внутри одного приоритета
+        self.jobs = {} # key -> Job (в очереди или в работе)
+        self.queued = 0
+        self.running = 0
+        self.tasks = []
+        self.recent = deque(maxlen=200) # (время окончания, байты) для throughput
+        self.stats = {'done': 0, 'failed': 0, 'rejected': 0, 'bytes': 0,
+                      'wait_total': 0.0, 'wait_max': 0.0, 'transfer_total': 0.0}
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, key, factory, priority=PRIORITY_CHOSEN):
+        """Future с результатом factory(). TransferBusy, если очередь забита"""
+        job = self.jobs.get(key)
+        if job is not None:
+            self.bump(key, priority)
+            return job.future
+
+        if self.queued >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise TransferBusy()
+
+        job = Job(key, factory, priority)
+        self.jobs[key] = job
+        self.queued += 1
+        self.queue.put_nowait((priority, next(self.seq), job))
+        return job.future
+
+    def bump(self, key, priority):
+        """Повторный клик поднимает уже стоящую задачу; старая запись будет пропущена"""
+        job = self.jobs.get(key)
+        if job is not None and not job.started and priority < job.priority:
+            job.priority = priority
+            self.queue.put_nowait((priority, next(self.seq), job))
+
+    def add_bytes(self, n):
+        if not n: return
+        self.stats['bytes'] += n
+        self.recent.append((time.monotonic(), n))
+
+    async def _worker(self):
+        while True:
+            priority, _, job = await self.queue.get()
+            if job.started or priority != job.priority: continue # устаревшая запись
+            job.started = True
+            self.queued -= 1
+            self.running += 1
+
+            started = time.monotonic()
+            wait = started - job.enqueued_at
+            TRANSFER_WAIT_SECONDS.observe(wait, str(priority))
+            self.stats['wait_total'] += wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+            try:
+                result = await job.factory()
+            except Exception as e:
+                self.stats['failed'] += 1
+                if not job.future.done(): job.future.set_exception(e)
+            else:
+                self.stats['done'] += 1
+                if not job.future.done(): job.future.set_result(result)
+            finally:
+                self.stats['transfer_total'] += time.monotonic() - started
+                self.running -= 1
+                self.jobs.pop(job.key, None)
+                # Исключение уже отдано ожидающим; без этого asyncio ругается "never retrieved"
+                if job.future.done() and not job.future.cancelled(): job.future.exception()
+
+    def snapshot(self):
+        finished = self.stats['done'] + self.stats['failed']
+        started = finished + self.running
+        now = time.monotonic()
+        window = [n for t, n in self.recent if now - t <= 60]
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'workers': self.workers,
+            **self.stats,
+            'wait_avg': self.stats['wait_total'] / started if started else 0.0,
+            'transfer_avg': self.stats['transfer_total'] / finished if finished else 0.0,
+            'throughput_bps_60s': sum(window) / 60,
+        }
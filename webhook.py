@@ -0,0 +1,68 @@
+import asyncio
+import hmac
+import logging
+import ujson
+from aiohttp import web
+from aiogram.types import Update
+
+logger = logging.getLogger("WEBHOOK")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookIngress:
+    """Приём апдейтов вебхуком на нашем aiohttp: проверка секрета, ограниченная параллельность,
+    аккуратное дожидание обработки при остановке"""
+
+    def __init__(self, dp, bot, secret, max_concurrent, max_pending):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret.encode()
+        self.sem = asyncio.Semaphore(max_concurrent)
+        self.max_pending = max_pending
+        self.tasks = set()
+        self.accepting = False # включаем, когда хендлеры готовы
+        self.stats = {'received': 0, 'rejected': 0, 'forbidden': 0, 'failed': 0}
+
+    async def handle(self, request):
+        token = request.headers.get(SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.stats['forbidden'] += 1
+            return web.Response(status=403)
+
+        # Не 200 - Telegram повторит апдейт позже: так отдаём backpressure наверх
+        if not self.accepting or len(self.tasks) >= self.max_pending:
+            self.stats['rejected'] += 1
+            return web.Response(status=503)
+
+        try:
+            update = Update.model_validate(await request.json(loads=ujson.loads), context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"🕸 Кривой апдейт: {e}")
+            return web.Response(status=400)
+
+        self.stats['received'] += 1
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        async with self.sem:
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"🕸 Ошибка обработки апдейта {update.update_id}: {e}")
+
+    async def drain(self, timeout):
+        """Перестаём принимать новые апдейты и ждём уже принятые"""
+        self.accepting = False
+        if not self.tasks: return
+        logger.info(f"🕸 Дожидаюсь {len(self.tasks)} апдейтов...")
+        _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+        if pending:
+            logger.warning(f"🕸 Не дождался {len(pending)} апдейтов, отменяю")
+            for t in pending: t.cancel()
+
+    def snapshot(self):
+        return {**self.stats, 'inflight': len(self.tasks), 'accepting': self.accepting}
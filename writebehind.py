@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("WRITES")
+
+class WriteBehind:
+    """Буфер записей в базу: копит upsert'ы по ключу (последний выигрывает) и сбрасывает
+    пачкой через flush_fn(dict) по размеру или по таймеру. Упавший сброс повторяется."""
+
+    def __init__(self, name, flush_fn, max_batch, interval):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.interval = interval
+        self.pending = {} # ключ -> значение, ещё не отправлено
+        self.flushing = {} # пачка, которая пишется прямо сейчас (тоже видна на чтение)
+        self.waiters = [] # futures тех, кто хочет дождаться записи
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.closing = False
+        self.failures = 0
+        self.counter = False # буфер счётчиков (add): при повторе прибавки складываются
+        self.stats = {'queued': 0, 'flushes': 0, 'rows': 0, 'errors': 0}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def put(self, key, value=None):
+        """Future, который завершится после записи пачки с этим ключом"""
+        self.pending[key] = value
+        self.stats['queued'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        if len(self.pending) >= self.max_batch: self.wakeup.set()
+        return future
+
+    def add(self, key, n=1):
+        """Счётчик: прибавки к одному ключу складываются до сброса (без ожидания записи)"""
+        self.counter = True
+        self.pending[key] = self.pending.get(key, 0) + n
+        self.stats['queued'] += 1
+        if len(self.pending) >= self.max_batch: self.wakeup.set()
+
+    def get(self, key, default=None):
+        """Читатели видят ещё не записанное"""
+        if key in self.pending: return self.pending[key]
+        return self.flushing.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.pending or key in self.flushing
+
+    async def _run(self):
+        while not self.closing:
+            # После ошибки ждём дольше, чтобы не долбить лежащую базу
+            delay = min(self.interval * 2 ** self.failures, 30)
+            try: await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError: pass
+            self.wakeup.clear()
+            if self.closing: break
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending or self.flushing: return
+        self.flushing, self.pending = self.pending, {}
+        waiters, self.waiters = self.waiters, []
+        try:
+            await self.flush_fn(self.flushing)
+        except BaseException as e:
+            if self.counter:
+                # Счётчики: несписанное прибавляем к тому, что набежало за время сброса
+                for key, n in self.flushing.items(): self.pending[key] = self.pending.get(key, 0) + n
+            else:
+                # Новые записи за время сброса свежее - их не перетираем
+                for key, value in self.flushing.items(): self.pending.setdefault(key, value)
+            self.waiters[:0] = waiters
+            self.flushing = {}
+            if not isinstance(e, Exception): raise # отмена - не ошибка базы
+            self.failures += 1
+            self.stats['errors'] += 1
+            logger.error(f"💾 {self.name}: сброс {len(self.pending)} строк не удался ({e}), повторю")
+            return
+        self.failures = 0
+        self.stats['flushes'] += 1
+        self.stats['rows'] += len(self.flushing)
+        self.flushing = {}
+        for future in waiters:
+            if not future.done(): future.set_result(True)
+
+    async def close(self):
+        """Остановить таймер и записать всё, что накопилось"""
+        # Не cancel: идущий сброс должен доехать, а не откатиться в pending
+        self.closing = True
+        self.wakeup.set()
+        if self.task:
+            await self.task
+            self.task = None
+        for _ in range(3):
+            if not self.pending: break
+            await self.flush()
+        if self.pending:
+            logger.error(f"💾 {self.name}: при остановке потеряно {len(self.pending)} строк")
+
+    def snapshot(self):
+        return {**self.stats, 'pending': len(self.pending) + len(self.flushing)}